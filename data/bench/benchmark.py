@@ -0,0 +1,382 @@
+#!/usr/bin/env python3
+
+"""
+Synthetic-genome benchmark of the python scripts.
+
+For each (genome length, segment count) of the grid:
+  - a random viral-like reference genome (ref.fa) is generated, split into
+    segments, with known SNPs and indels at set proportions
+  - the mutations are written as expected results (<name>.snp.csv,
+    <name>.indel.csv, same format as data/test/input/expected_results) and
+    as found mutations (ivar like found.tsv with frequency noise and
+    spurious low frequency calls)
+  - the consensus (mutations with proportion >= 0.5) is the assembly
+    (alt.fa: shuffled segments, one out of two reverse complemented)
+  - a random annotation of the first segment (annot.tsv)
+then the wall time, CPU time and peak RSS are measured for:
+  - align_coords.py alt.fa vs ref.fa
+  - transfer_annot.py get_ref2alt (first segment), process_file (row engine)
+    and process_file_columnar, each one in its own process so that its peak
+    RSS is not the one of the alignment
+  - check_results.py expected vs found mutations
+with each alignment mode of --modes:
+  - default: the default options of the scripts (exhaustive alignments)
+  - anchored: align_coords.py --top_k 2 --align_mode anchored and
+    transfer_annot.py --align_mode anchored
+Each measurement records its mode, so that the default path and the anchored
+path are compared separately between commits.
+
+Results are written as JSON (with the commit and the parameters) and two
+results files can be compared with the compare command:
+
+  python3 data/bench/benchmark.py run --out bench_new.json
+  python3 data/bench/benchmark.py compare bench_old.json bench_new.json
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import platform
+import tempfile
+import subprocess
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(os.path.dirname(BENCH_DIR))
+SCRIPTS_DIR = os.path.join(REPO_DIR, "scripts")
+CHECK_RESULTS = os.path.join(REPO_DIR, "data", "test", "check_results.py")
+
+DEFAULT_GRID = "10000x1,50000x4,100000x8,250000x20"
+
+# Alignment modes: (extra arguments of align_coords.py, --align_mode of transfer_annot.py)
+MODES = {
+  "default": ([], "exhaustive"),
+  "anchored": (["--top_k", "2", "--align_mode", "anchored"], "anchored")
+}
+
+COMPLEMENT = str.maketrans("ACGT", "TGCA")
+
+# Measure a transfer_annot.py phase in a child process (so that its peak RSS
+# is the one of the phase), prints JSON. get_ref2alt saves the map it returns
+# to map_file, loaded by the other phases.
+TRANSFER_CHILD = """
+import sys, json, time, resource
+import numpy as np
+sys.path.insert(0, sys.argv[1])
+import transfer_annot
+from coords_io import CoordMap
+phase, ref_file, alt_file, annot_file, out_file, map_file, align_mode, anchor_size = sys.argv[2:10]
+def measure(func, *args):
+  wall, cpu = time.perf_counter(), time.process_time()
+  result = func(*args)
+  return result, {"phase": phase, "wall_s": time.perf_counter() - wall,
+    "cpu_s": time.process_time() - cpu,
+    "peak_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss}
+if phase == "get_ref2alt":
+  ref2alt, measured = measure(transfer_annot.get_ref2alt, ref_file, alt_file, False, False, align_mode, int(anchor_size))
+  np.savez(map_file, starts=ref2alt.starts, values=ref2alt.values, aligned=ref2alt.aligned, size=ref2alt.size)
+else:
+  with np.load(map_file) as saved:
+    ref2alt = CoordMap(saved["starts"], saved["values"], saved["aligned"], int(saved["size"]))
+  _, measured = measure(getattr(transfer_annot, phase), annot_file, out_file, [1, 2, 6, 7], 11, 10, "\\t", ",", ref2alt)
+print(json.dumps(measured))
+"""
+
+TRANSFER_PHASES = ["get_ref2alt", "process_file", "process_file_columnar"]
+
+def parse_grid(grid):
+  """Parse "<length>x<segments>,..." into a list of (length, segments)"""
+  sizes = []
+  for item in grid.split(","):
+    length, segments = item.lower().split("x")
+    sizes.append((int(length), int(segments)))
+  return sizes
+
+def random_segment(length, rng, gc=0.45, repeat_rate=0.01):
+  """Random sequence with some homopolymers and short tandem repeats"""
+  weights = [(1 - gc) / 2, gc / 2, gc / 2, (1 - gc) / 2]
+  seq = []
+  while len(seq) < length:
+    if rng.random() < repeat_rate:
+      unit = rng.choices("ACGT", weights, k=rng.randint(1, 3))
+      seq.extend(unit * rng.randint(3, 6))
+    else:
+      seq.extend(rng.choices("ACGT", weights, k=50))
+  return "".join(seq[:length])
+
+def random_mutations(segment, rng, snp_rate, indel_rate, spacing=20):
+  """
+  Draw non overlapping mutations of a segment, returns sorted tuples
+  (pos, kind, ref, alt, proportion), pos being 0-based for SNPs and the 0-based
+  index of the first base after the indel for indels (1-based position of the
+  base before it, ivar convention).
+  """
+  mutations = []
+  pos = spacing
+  while pos < len(segment) - spacing:
+    pos += max(1, int(rng.expovariate(snp_rate + indel_rate)))
+    if pos >= len(segment) - spacing:
+      break
+    proportion = round(rng.choice([rng.uniform(0.05, 0.5), rng.uniform(0.5, 1.0)]), 3)
+    if rng.random() < snp_rate / (snp_rate + indel_rate):
+      alt = rng.choice([base for base in "ACGT" if base != segment[pos]])
+      mutations.append((pos, "snp", segment[pos], alt, proportion))
+    else:
+      size = rng.randint(1, 6)
+      if rng.random() < 0.5:
+        mutations.append((pos, "deletion", segment[pos:pos + size], "", proportion))
+      else:
+        inserted = "".join(rng.choices("ACGT", k=size))
+        mutations.append((pos, "insertion", "", inserted, proportion))
+    pos += spacing
+  return mutations
+
+def apply_mutations(segment, mutations, min_proportion=0.5):
+  """Consensus sequence with the mutations of proportion >= min_proportion"""
+  parts = []
+  last = 0
+  for pos, kind, ref, alt, proportion in mutations:
+    if proportion < min_proportion:
+      continue
+    parts.append(segment[last:pos])
+    if kind == "snp":
+      parts.append(alt)
+      last = pos + 1
+    elif kind == "deletion":
+      last = pos + len(ref)
+    else:
+      parts.append(alt)
+      last = pos
+  parts.append(segment[last:])
+  return "".join(parts)
+
+def reverse_complement(seq):
+  return seq.translate(COMPLEMENT)[::-1]
+
+def write_fasta(fasta_file, records, width=60):
+  with open(fasta_file, "w") as f:
+    for seq_id, seq in records:
+      f.write(f">{seq_id}\n")
+      for start in range(0, len(seq), width):
+        f.write(seq[start:start + width] + "\n")
+
+def generate_dataset(work_dir, length, n_segments, rng, args):
+  """Write the synthetic genome and its expected / found mutations in work_dir"""
+  os.makedirs(work_dir, exist_ok=True)
+  # Segment lengths around length / n_segments
+  shares = [rng.uniform(0.7, 1.3) for _ in range(n_segments)]
+  sizes = [max(100, int(length * share / sum(shares))) for share in shares]
+  segments = [(f"seg{idx}", random_segment(size, rng)) for idx, size in enumerate(sizes)]
+  write_fasta(os.path.join(work_dir, "ref.fa"), segments)
+
+  alt_records = []
+  n_snps = n_indels = 0
+  with open(os.path.join(work_dir, "sample.snp.csv"), "w") as snp_f, \
+      open(os.path.join(work_dir, "sample.indel.csv"), "w") as indel_f, \
+      open(os.path.join(work_dir, "found.tsv"), "w") as found_f:
+    snp_f.write("region,position,ref_base,alt_base,proportion\n")
+    indel_f.write("region,position,type,sequence,proportion\n")
+    found_f.write("REGION\tPOS\tREF\tALT\tREF_DP\tALT_DP\tALT_FREQ\n")
+    for seq_id, segment in segments:
+      mutations = random_mutations(segment, rng, args.snp_rate, args.indel_rate)
+      found = []
+      for pos, kind, ref, alt, proportion in mutations:
+        if kind == "snp":
+          n_snps += 1
+          snp_f.write(f"{seq_id},{pos},{ref},{alt},{proportion}\n")
+          found.append((pos + 1, ref, alt))
+        else:
+          n_indels += 1
+          sequence = ref if kind == "deletion" else alt
+          indel_f.write(f"{seq_id},{pos},{kind},{sequence},{proportion}\n")
+          found.append((pos, segment[pos - 1], ("-" if kind == "deletion" else "+") + sequence))
+        found[-1] += (min(1.0, max(0.0, round(proportion + rng.uniform(-0.02, 0.02), 3))),)
+      # Missed calls and spurious low frequency calls
+      found = [call for call in found if rng.random() >= args.miss_rate]
+      for _ in range(int(len(segment) * args.noise_rate)):
+        pos = rng.randrange(1, len(segment) - 10)
+        alt = rng.choice([base for base in "ACGT" if base != segment[pos - 1]])
+        found.append((pos, segment[pos - 1], alt, round(rng.uniform(0.001, 0.03), 3)))
+      for pos, ref, alt, freq in sorted(found):
+        depth = 1000
+        found_f.write(f"{seq_id}\t{pos}\t{ref}\t{alt}\t{depth - int(depth * freq)}\t{int(depth * freq)}\t{freq}\n")
+      alt_records.append((seq_id, apply_mutations(segment, mutations)))
+
+  # Assembly: shuffled segments, one out of two reverse complemented
+  order = list(range(n_segments))
+  rng.shuffle(order)
+  write_fasta(os.path.join(work_dir, "alt.fa"), [
+    (f"asm{idx}", reverse_complement(alt_records[idx][1]) if idx % 2 else alt_records[idx][1])
+    for idx in order
+  ])
+  # Single segment pair for transfer_annot.py
+  write_fasta(os.path.join(work_dir, "ref1.fa"), [segments[0]])
+  write_fasta(os.path.join(work_dir, "alt1.fa"), [("asm0", alt_records[0][1])])
+  write_annotation(os.path.join(work_dir, "annot.tsv"), segments[0], args.annot_rows, rng)
+  return {"snps": n_snps, "indels": n_indels, "segment_sizes": sizes}
+
+def write_annotation(annot_file, segment, n_rows, rng):
+  """
+  Random annotation of a segment with the default transfer_annot.py layout:
+  start and end in columns 1, 2, 6, 7 and start / size lists in columns 11, 10
+  """
+  seq_id, seq = segment
+  with open(annot_file, "w") as f:
+    for _ in range(n_rows):
+      start = rng.randrange(0, len(seq) - 50)
+      end = start + rng.randint(1, 40)
+      row = [seq_id, str(start), str(end), "gene", ".", "+", f"{start},{start + 1}", str(end), ".", ".",
+        f"{end - start},3", f"{start},{start + 2}"]
+      f.write("\t".join(row) + "\n")
+
+def run_measured(cmd, log_file):
+  """Run a command, return its wall time, CPU time and peak RSS (of the child only)"""
+  with open(log_file, "w") as log:
+    start = time.perf_counter()
+    process = subprocess.Popen(cmd, stdout=log, stderr=subprocess.STDOUT)
+    _, status, usage = os.wait4(process.pid, 0)
+    wall = time.perf_counter() - start
+  return {
+    "wall_s": wall,
+    "cpu_s": usage.ru_utime + usage.ru_stime,
+    "peak_rss_kb": usage.ru_maxrss,
+    "status": os.waitstatus_to_exitcode(status)
+  }
+
+def run_transfer_phases(work_dir, mode, args):
+  """Measure the transfer_annot.py phases, each one in its own child process"""
+  phases = []
+  with open(os.path.join(work_dir, f"transfer_annot.{mode}.log"), "w") as log:
+    for phase in TRANSFER_PHASES:
+      cmd = [sys.executable, "-c", TRANSFER_CHILD, SCRIPTS_DIR, phase,
+        os.path.join(work_dir, "ref1.fa"), os.path.join(work_dir, "alt1.fa"), os.path.join(work_dir, "annot.tsv"),
+        os.path.join(work_dir, f"annot.{mode}.tsv"), os.path.join(work_dir, f"ref2alt.{mode}.npz"),
+        MODES[mode][1], str(args.anchor_size)]
+      result = subprocess.run(cmd, capture_output=True, text=True)
+      log.write(result.stderr)
+      if result.returncode != 0:
+        # the next phases need the map of get_ref2alt
+        phases.append({"phase": phase, "status": result.returncode})
+        break
+      phases.append(dict(json.loads(result.stdout.strip().splitlines()[-1]), status=0))
+  return phases
+
+def git_commit():
+  try:
+    return subprocess.run(["git", "-C", REPO_DIR, "rev-parse", "HEAD"], capture_output=True, text=True,
+      check=True).stdout.strip()
+  except (OSError, subprocess.CalledProcessError):
+    return None
+
+def run(args):
+  modes = args.modes.split(",")
+  unknown = [mode for mode in modes if mode not in MODES]
+  if unknown:
+    sys.exit(f"Unknown mode(s) {','.join(unknown)}, choose among {','.join(MODES)}")
+  rng = random.Random(args.seed)
+  work_root = args.work_dir or tempfile.mkdtemp(prefix="viral_variant_bench_")
+  results = []
+  for length, n_segments in parse_grid(args.grid):
+    name = f"{length}x{n_segments}"
+    work_dir = os.path.join(work_root, name)
+    dataset = generate_dataset(work_dir, length, n_segments, rng, args)
+    size = {"length": length, "segments": n_segments}
+    print(f"{name}: {dataset['snps']} SNPs, {dataset['indels']} indels", file=sys.stderr)
+    n_results = len(results)
+
+    for mode in modes:
+      align_cmd = [sys.executable, os.path.join(SCRIPTS_DIR, "align_coords.py"),
+        "--queries", os.path.join(work_dir, "alt.fa"), "--targets", os.path.join(work_dir, "ref.fa"),
+        "--out_dir", os.path.join(work_dir, f"align_coords.{mode}")] + MODES[mode][0] + args.align_coords_args.split()
+      results.append(dict(size, tool="align_coords", phase="total", mode=mode,
+        **run_measured(align_cmd, os.path.join(work_dir, f"align_coords.{mode}.log"))))
+
+      for phase in run_transfer_phases(work_dir, mode, args):
+        results.append(dict(size, tool="transfer_annot", mode=mode, **phase))
+
+    check_cmd = [sys.executable, CHECK_RESULTS, os.path.join(work_dir, "sample.indel.csv"),
+      os.path.join(work_dir, "sample.snp.csv"), os.path.join(work_dir, "found.tsv"), os.path.join(work_dir, "ref.fa")]
+    results.append(dict(size, tool="check_results", phase="total",
+      **run_measured(check_cmd, os.path.join(work_dir, "check_results.log"))))
+
+    for result in results[n_results:]:
+      print(f"  {result['tool']:<15} {result['phase']:<22} {result.get('mode', ''):<9} {result.get('wall_s', float('nan')):8.2f} s "
+        f"{result.get('peak_rss_kb', 0) / 1024:8.1f} MB status {result['status']}", file=sys.stderr)
+
+  output = {
+    "meta": {
+      "commit": git_commit(),
+      "date": time.strftime("%Y-%m-%dT%H:%M:%S"),
+      "python": platform.python_version(),
+      "machine": platform.machine(),
+      "cpu_count": os.cpu_count(),
+      "params": {key: value for key, value in vars(args).items() if key != "func"},
+      "work_dir": work_root
+    },
+    "results": results
+  }
+  with open(args.out, "w") as f:
+    json.dump(output, f, indent=2)
+
+def compare(args):
+  """Print the ratio new / old of wall time and peak RSS for each measurement"""
+  with open(args.old) as f:
+    old = json.load(f)
+  with open(args.new) as f:
+    new = json.load(f)
+  key = lambda result: (result["tool"], result["phase"], result.get("mode"), result["length"], result["segments"])
+  old_results = {key(result): result for result in old["results"]}
+  print(f"old: {old['meta'].get('commit')}  new: {new['meta'].get('commit')}")
+  print(f"{'tool':<15} {'phase':<22} {'mode':<9} {'size':>10} {'old_s':>9} {'new_s':>9} {'time':>6} {'old_MB':>8} {'new_MB':>8} {'rss':>6}")
+  n_regressions = 0
+  for result in new["results"]:
+    previous = old_results.get(key(result))
+    if previous is None or "wall_s" not in previous or "wall_s" not in result:
+      continue
+    time_ratio = result["wall_s"] / max(previous["wall_s"], 1e-9)
+    rss_ratio = result["peak_rss_kb"] / max(previous["peak_rss_kb"], 1)
+    flag = ""
+    if time_ratio > args.threshold or rss_ratio > args.threshold:
+      flag = "  REGRESSION"
+      n_regressions += 1
+    print(f"{result['tool']:<15} {result['phase']:<22} {result.get('mode', ''):<9} {str(result['length']) + 'x' + str(result['segments']):>10} "
+      f"{previous['wall_s']:9.2f} {result['wall_s']:9.2f} {time_ratio:6.2f} "
+      f"{previous['peak_rss_kb'] / 1024:8.1f} {result['peak_rss_kb'] / 1024:8.1f} {rss_ratio:6.2f}{flag}")
+  if n_regressions:
+    sys.exit(f"{n_regressions} measurement(s) above {args.threshold}x")
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawTextHelpFormatter)
+  subparsers = parser.add_subparsers(dest="command", required=True)
+
+  run_parser = subparsers.add_parser("run", help="Generate the genomes and run the benchmark")
+  run_parser.add_argument("--grid", default=DEFAULT_GRID,
+    help=f"Comma separated <genome length>x<segment count> (default {DEFAULT_GRID})")
+  run_parser.add_argument("--seed", type=int, default=1, help="Random seed of the generated data")
+  run_parser.add_argument("--snp_rate", type=float, default=0.005, help="SNPs per base")
+  run_parser.add_argument("--indel_rate", type=float, default=0.0005, help="Indels per base")
+  run_parser.add_argument("--miss_rate", type=float, default=0.05, help="Fraction of mutations not found")
+  run_parser.add_argument("--noise_rate", type=float, default=0.01, help="Spurious found calls per base")
+  run_parser.add_argument("--annot_rows", type=int, default=100000, help="Number of rows of the annotation")
+  run_parser.add_argument("--modes", default=",".join(MODES),
+    help=f"Comma separated alignment modes to measure, among {','.join(MODES)} (default all)")
+  run_parser.add_argument("--align_coords_args", default="", help="Extra arguments of align_coords.py (all modes)")
+  run_parser.add_argument("--anchor_size", type=int, default=15, help="--anchor_size of transfer_annot.py (anchored mode)")
+  run_parser.add_argument("--work_dir", default=None, help="Directory of the generated data (default: temporary)")
+  run_parser.add_argument("--out", default="bench_results.json", help="Results file (JSON)")
+  run_parser.set_defaults(func=run)
+
+  compare_parser = subparsers.add_parser("compare", help="Compare two results files")
+  compare_parser.add_argument("old", help="Results file of the baseline")
+  compare_parser.add_argument("new", help="Results file to compare")
+  compare_parser.add_argument("--threshold", type=float, default=1.2,
+    help="Ratio new / old of wall time or peak RSS reported as a regression")
+  compare_parser.set_defaults(func=compare)
+
+  args = parser.parse_args()
+  args.func(args)
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+
+"""
+Agreement check of the alignment backends (scripts/align_backends.py).
+
+Pairs of synthetic segments (random_segment of benchmark.py, with SNPs and
+indels, trimmed ends and some unrelated pairs) are scored and aligned by each
+engine with each scoring preset, and by the biopython engine without memory
+budget (linear memory alignment). For each (preset, engine) are reported:
+  - score: pairs whose score is the one of PairwiseAligner.score
+  - path: pairs whose best alignment has this optimal score (the score of the
+    coordinates is recomputed from the preset)
+  - same_coords: pairs whose coordinates are the ones of PairwiseAligner.align
+    (co-optimal alignments may differ)
+and for the banded scores of the screening (banded_scores, each target
+against its query and the next 3 ones, of other lengths), with a band
+covering the whole DP matrix then with --band:
+  - score: pairs whose banded score is the one of PairwiseAligner.score
+  - path: pairs whose banded score is at most the one of
+    PairwiseAligner.score (a lower bound)
+The exit status is 1 if a score or a path score differs, or if a banded
+score is above the optimal one or differs from it with the whole band.
+
+  python3 data/bench/check_backends.py --pairs 100 --length 3000
+"""
+
+import os
+import sys
+import random
+import argparse
+import warnings
+import numpy as np
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCH_DIR, "..", "..", "scripts"))
+sys.path.insert(0, BENCH_DIR)
+from align_backends import ENGINES, SCORING_PRESETS, banded_scores, get_backend
+from benchmark import random_segment, random_mutations, apply_mutations
+
+def path_score(aligner, target, query, coordinates):
+  """Score of the alignment path given by coordinates with the aligner settings"""
+  score = 0.0
+  for (i, j), (next_i, next_j) in zip(coordinates.T[:-1].tolist(), coordinates.T[1:].tolist()):
+    if next_i > i and next_j > j:
+      score += sum(aligner.match_score if a == b else aligner.mismatch_score
+        for a, b in zip(target[i:next_i], query[j:next_j]))
+      continue
+    # gap in the query (target letters) or in the target (query letters)
+    seq, size, pos, length = ("query", len(query), j, next_i - i) if next_i > i else ("target", len(target), i, next_j - j)
+    side = "left" if pos == 0 else "right" if pos == size else "internal"
+    score += getattr(aligner, f"{seq}_{side}_open_gap_score") + \
+      (length - 1) * getattr(aligner, f"{seq}_{side}_extend_gap_score")
+  return score
+
+def random_pair(rng, max_length, snp_rate, indel_rate):
+  """Segment and its mutated copy (trimmed ends or an unrelated sequence for some pairs)"""
+  target = random_segment(rng.randint(50, max_length), rng)
+  if rng.random() < 0.1:
+    return target, random_segment(rng.randint(50, max_length), rng)
+  query = apply_mutations(target, random_mutations(target, rng, snp_rate, indel_rate, spacing=5), 0.0)
+  if rng.random() < 0.3:
+    query = query[rng.randint(0, len(query) // 10):len(query) - rng.randint(0, len(query) // 10)]
+  return target, query
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawTextHelpFormatter)
+  parser.add_argument("--pairs", type=int, default=50, help="Number of pairs")
+  parser.add_argument("--length", type=int, default=2000, help="Maximum segment length")
+  parser.add_argument("--seed", type=int, default=1, help="Random seed of the pairs")
+  parser.add_argument("--snp_rate", type=float, default=0.02, help="SNPs per base")
+  parser.add_argument("--indel_rate", type=float, default=0.005, help="Indels per base")
+  parser.add_argument("--band", type=int, default=32, help="Band of the banded scores")
+  args = parser.parse_args()
+  warnings.simplefilter("ignore")
+
+  rng = random.Random(args.seed)
+  pairs = [random_pair(rng, args.length, args.snp_rate, args.indel_rate) for _ in range(args.pairs)]
+  failed = False
+  print("scoring\tengine\tpairs\tscore\tpath\tsame_coords")
+  for scoring in SCORING_PRESETS:
+    reference = get_backend("biopython", scoring)
+    expected = [(reference.score(target, query), reference.align(target, query)[0].coordinates)
+      for target, query in pairs]
+    # the biopython engine with a null memory budget runs the linear memory alignment
+    backends = [(engine, get_backend(engine, scoring)) for engine in ENGINES] + \
+      [("biopython_linear", get_backend("biopython", scoring, max_memory=0))]
+    for name, backend in backends:
+      same_score = same_path = same_coords = 0
+      for (target, query), (score, coordinates) in zip(pairs, expected):
+        alignment = backend.align(target, query)[0]
+        same_score += backend.score(target, query) == score
+        same_path += alignment.score == score and path_score(backend.aligner, target, query, alignment.coordinates) == score
+        same_coords += np.array_equal(alignment.coordinates, coordinates)
+      failed |= same_score < len(pairs) or same_path < len(pairs)
+      print(f"{scoring}\t{name}\t{len(pairs)}\t{same_score}\t{same_path}\t{same_coords}")
+    # banded scores of the screening: exact with a band covering the matrix
+    for name, band in (("banded_full", args.length), (f"banded_{args.band}", args.band)):
+      queries = [query for _, query in pairs]
+      scores = [banded_scores(reference.aligner, target, queries[idx:idx + 4], band)[0]
+        for idx, (target, _) in enumerate(pairs)]
+      same_score = sum(score == expected_score for score, (expected_score, _) in zip(scores, expected))
+      lower_bound = sum(score <= expected_score for score, (expected_score, _) in zip(scores, expected))
+      failed |= lower_bound < len(pairs) or (band == args.length and same_score < len(pairs))
+      print(f"{scoring}\t{name}\t{len(pairs)}\t{same_score}\t{lower_bound}\t")
+  sys.exit(1 if failed else 0)
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+
+"""
+Agreement check of the transfer_annot.py engines on ragged annotations.
+
+A random segment and its mutated copy (benchmark.py generators) are aligned
+once, then random annotations mixing BED6, BED8 and BED12 rows (in random
+order, so that short rows follow long ones and the reverse) are transformed
+by the row engine (process_file, --chunk_size 0) and by the columnar engine
+(process_file_columnar) with several chunk sizes. For each (columns, chunk
+size) the outputs must be byte-identical, or both engines must raise the
+same error (e.g. a transformed column missing from BED6 rows). The exit
+status is 1 otherwise.
+
+  python3 data/bench/check_transfer.py --rows 2000
+"""
+
+import os
+import sys
+import random
+import argparse
+import tempfile
+import warnings
+from Bio.Seq import Seq
+from Bio.SeqRecord import SeqRecord
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCH_DIR, "..", "..", "scripts"))
+sys.path.insert(0, BENCH_DIR)
+from transfer_annot import align_ref2alt, process_file, process_file_columnar
+from benchmark import random_segment, random_mutations, apply_mutations
+
+# (columns to transform, BED widths of the rows)
+CASES = [
+  ([1, 2, 6, 7], (8, 12)),
+  ([1, 2], (6, 8, 12)),
+  ([1, 2, 6, 7], (6, 8, 12))
+]
+
+CHUNK_SIZES = [1, 7, 100000]
+
+def write_ragged_annotation(annot_file, seq_id, length, n_rows, widths, rng):
+  """Random BED rows of the given widths (start / size lists in columns 11, 10)"""
+  with open(annot_file, "w") as f:
+    for _ in range(n_rows):
+      start = rng.randrange(0, length - 50)
+      end = start + rng.randint(1, 40)
+      row = [seq_id, str(start), str(end), "gene", ".", "+", str(start), str(end), "0", "2",
+        f"{end - start},3", f"{start},{start + 2}"]
+      f.write("\t".join(row[:rng.choice(widths)]) + "\n")
+
+def run_engine(process, annot_file, out_file, columns, ref2alt, *chunk_size):
+  """Output bytes of an engine, or the error it raised"""
+  try:
+    process(annot_file, out_file, columns, 11, 10, "\t", ",", ref2alt, None, *chunk_size)
+  except ValueError as e:
+    return f"{type(e).__name__}: {e}"
+  with open(out_file, "rb") as f:
+    return f.read()
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawTextHelpFormatter)
+  parser.add_argument("--rows", type=int, default=2000, help="Number of rows of each annotation")
+  parser.add_argument("--length", type=int, default=5000, help="Segment length")
+  parser.add_argument("--seed", type=int, default=1, help="Random seed")
+  args = parser.parse_args()
+  warnings.simplefilter("ignore")
+
+  rng = random.Random(args.seed)
+  ref = random_segment(args.length, rng)
+  alt = apply_mutations(ref, random_mutations(ref, rng, 0.02, 0.005), 0.0)
+  ref2alt = align_ref2alt(SeqRecord(Seq(ref), id="ref"), SeqRecord(Seq(alt), id="alt"), False, False)
+
+  failed = False
+  print("columns\twidths\tchunk_size\tresult")
+  with tempfile.TemporaryDirectory() as work_dir:
+    annot_file = os.path.join(work_dir, "annot.bed")
+    for columns, widths in CASES:
+      write_ragged_annotation(annot_file, "ref", len(ref), args.rows, widths, rng)
+      expected = run_engine(process_file, annot_file, os.path.join(work_dir, "rows.bed"), columns, ref2alt)
+      for chunk_size in CHUNK_SIZES:
+        found = run_engine(process_file_columnar, annot_file, os.path.join(work_dir, "columnar.bed"),
+          columns, ref2alt, chunk_size)
+        result = "same" if found == expected else "different"
+        if isinstance(expected, str):
+          result += " error"
+        failed |= found != expected
+        print(f"{','.join(map(str, columns))}\t{','.join(map(str, widths))}\t{chunk_size}\t{result}")
+  sys.exit(1 if failed else 0)
+
+if __name__ == "__main__":
+  main()
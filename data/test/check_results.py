@@ -1,154 +1,244 @@
 import pandas as pd
 import argparse
 import sys
+import os
+import glob
+import hashlib
+from bisect import bisect_left, bisect_right
+from concurrent.futures import ProcessPoolExecutor
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "scripts"))
+from run_metrics import metrics
+from table_io import TABLE_FORMATS, read_table, write_table
+from ref_index import load_index
 
 # Here is the idea, could you analyse it and make sure the position are good, tell in comment what is 0-based and what is 1-based
 
-def get_alt_seq_from_indel(alt, pos, base_seq):
-  # parse alt
+def normalize_indel(alt, pos, reference_sequence):
+  """
+  Left-normalize an indel against the reference.
+
+  pos is 1-based, the position of the base before the indel (ivar convention),
+  i.e. the 0-based index of the first base after it. alt is "+<inserted seq>"
+  or "-<deleted seq>" (only the size of a deletion is used, deleted bases are
+  read from the reference).
+  Returns (start, alt) of the leftmost equivalent indel, start being the
+  0-based index of the first base after it, so that equivalent indels have the
+  same canonical form.
+  """
   sign = alt[0]
-  alt_seq = alt[1:]
+  seq = alt[1:]
+  start = pos
   if sign == "-":
-    del_size = len(alt_seq)
-    return(base_seq[0:pos+1]+base_seq[1+pos+del_size:])
-  else:
-    return(base_seq[0:pos+1]+alt_seq+base_seq[1+pos:])
+    size = len(seq)
+    while start > 0 and start + size <= len(reference_sequence) and \
+        reference_sequence[start - 1] == reference_sequence[start + size - 1]:
+      start -= 1
+    return start, "-" + reference_sequence[start:start + size]
+  while seq and start > 0 and reference_sequence[start - 1] == seq[-1]:
+    seq = seq[-1] + seq[:-1]
+    start -= 1
+  return start, "+" + seq
 
-def compare_indels(expected_region, expected_pos, expected_alt, found_mutations, reference_sequence, tolerance=10, flank=3):
+class IndexedReference:
   """
-  Compare indels based on expected and found positions and sequences.
+  Contig sequences of a reference index (ref_index.py), read from its memory
+  map when first used. Pickled by path, so the batch workers share the page
+  cache of the index instead of receiving a copy of the reference.
   """
-  for _, found in found_mutations.iterrows():
-      found_region = found['REGION']
-      found_pos = found['POS']
-      found_alt = found['ALT']
 
-      # Check if positions are within the tolerance range
-      if (abs(expected_pos - found_pos) <= tolerance) and (expected_region == found_region):
-          # Determine the range for sequence comparison
-          start = min(expected_pos, found_pos) - flank -1
-          end = max(expected_pos, found_pos) + flank
+  def __init__(self, index):
+    self.index = index
+    self.sequences = {}
 
-          # Extract sequences for comparison
-          base_seq = reference_sequence[start:end]
+  def __contains__(self, contig):
+    return contig in self.index
 
-          # parse
-          found_alt_seq = get_alt_seq_from_indel(found_alt, found_pos - start - 1, base_seq)
-          expected_alt_seq = get_alt_seq_from_indel(expected_alt, expected_pos - start - 1, base_seq)
+  def __getitem__(self, contig):
+    if contig not in self.sequences:
+      self.sequences[contig] = self.index.fetch(contig)
+    return self.sequences[contig]
 
-          # Check if the sequences match
-          if expected_alt_seq == found_alt_seq:
-              return found
+def read_reference(reference_file):
+  """
+  Read a (multi) fasta reference, return a mapping of each contig id to its
+  sequence (from the reference index <fasta>.vvi if up to date)
+  """
+  index = load_index(reference_file)
+  if index is not None:
+    return IndexedReference(index)
+  reference = {}
+  contig = None
+  with open(reference_file, 'r') as ref_file:
+    for line in ref_file:
+      line = line.rstrip()
+      if not line:
+        continue
+      if line[0] == ">":
+        contig = line[1:].split()[0]
+        reference[contig] = []
+      else:
+        reference[contig].append(line)
+  return {contig: "".join(lines) for contig, lines in reference.items()}
 
-  return None
+def canonical_indel(region, pos, alt, reference):
+  """Return the canonical key of an indel, (region, pos, alt) as is if the region is not in the reference"""
+  if region not in reference:
+    return (region, pos, alt)
+  return (region,) + normalize_indel(alt, pos, reference[region])
 
+def index_indels(found_mutations, reference):
+  """
+  Index the found indels by canonical form.
 
-def compare_mutations(expected_indel_file, expected_snp_file, found_file, reference_file):
-  # Load expected mutations
-  expected_indels = pd.read_csv(expected_indel_file)
-  expected_snps = pd.read_csv(expected_snp_file)
+  Returns a dict mapping (region, normalized start, normalized alt) to the
+  sorted positions of the found indels with this form, their row numbers and
+  their alts as found.
+  """
+  index = {}
+  for row, (region, pos, alt) in enumerate(zip(found_mutations['REGION'], found_mutations['POS'], found_mutations['ALT'])):
+    if isinstance(alt, str) and alt[:1] in ("+", "-"):
+      key = canonical_indel(region, int(pos), alt, reference)
+      index.setdefault(key, []).append((int(pos), row, alt))
+  for entries in index.values():
+    entries.sort()
+  return {key: tuple(map(list, zip(*entries))) for key, entries in index.items()}
 
-  # Load found mutations
-  found_mutations = pd.read_csv(found_file, sep='\t')
+def compare_indels(expected_region, expected_pos, expected_alt, indel_index, reference, tolerance=10):
+  """
+  Return the row number of the found indel equivalent to the expected one
+  (same canonical form) within the tolerance range that is the closest to
+  expected_pos, an exact alt being preferred at the same distance (then the
+  lowest position), None if there is none.
 
-  # Load reference sequence
-  reference_sequence = ""
-  with open(reference_file, 'r') as ref_file:
-    for line in ref_file.readlines():
-      line = line.rstrip()
-      if line[0] != ">": reference_sequence += line
+  As indels are compared by canonical (left-normalized) form, a found indel
+  written at another position of a repeat (e.g. -A at 284 for -A at 287 in
+  a poly-A) is matched, where the baseline compared (pos, alt) as written.
+  """
+  key = canonical_indel(expected_region, expected_pos, expected_alt, reference)
+  if key not in indel_index:
+    return None
+  positions, rows, alts = indel_index[key]
+  first = bisect_left(positions, expected_pos - tolerance)
+  last = bisect_right(positions, expected_pos + tolerance)
+  if first == last:
+    return None
+  best = min(range(first, last), key=lambda idx: (abs(positions[idx] - expected_pos), alts[idx] != expected_alt))
+  return rows[best]
+
+
+def compare_mutations(expected_indel_file, expected_snp_file, found_file, reference):
+  """
+  Compare the expected mutations with the found ones, reference is a dict
+  from read_reference. Returns the results DataFrame (proportions in %).
+  """
+  with metrics.phase("read_inputs"):
+    # Load expected mutations
+    expected_indels = pd.read_csv(expected_indel_file)
+    expected_snps = pd.read_csv(expected_snp_file)
+
+    # Load found mutations
+    found_mutations = pd.read_csv(found_file, sep='\t')
+  metrics.count("expected_snps", len(expected_snps))
+  metrics.count("expected_indels", len(expected_indels))
+  metrics.count("found_rows", len(found_mutations))
 
   # Adjust positions for comparison (0-based to 1-based)
   expected_snps['position'] += 1
 
-  # Prepare a DataFrame for results
-  results = []
-
-  # Compare SNPs
-  for _, expected in expected_snps.iterrows():
-      region = expected['region']
-      pos = expected['position']
-      alt_base = expected['alt_base']
-      expected_prop = expected['proportion']
-
-      # Find matching found mutation
-      found = found_mutations[(found_mutations['REGION'] == region) & (found_mutations['POS'] == pos) & (found_mutations['ALT'] == alt_base)]
-      if not found.empty:
-          found_freq = found['ALT_FREQ'].values[0]
-          results.append({
-              'region': found['REGION'].values[0],
-              'found_pos': found['POS'].values[0],
-              'expected_pos': pos,
-              'expected_alt': alt_base,
-              'expected_prop': expected_prop,
-              'found_alt': found['ALT'].values[0],
-              'found_freq': found_freq
-          })
-      else:
-          results.append({
-              'region': region,
-              'found_pos': None,
-              'expected_pos': pos,
-              'expected_alt': alt_base,
-              'expected_prop': expected_prop,
-              'found_alt': None,
-              'found_freq': 0
-          })
-
-  # Compare Indels
-  for _, expected in expected_indels.iterrows():
-      region = expected['region']
-      pos = expected['position']
-      alt_base = expected['sequence']
-      if expected['type'] == "insertion": 
-        alt_base = "+" + expected['sequence']
-      if expected['type'] == "deletion": 
-        alt_base = "-" + expected['sequence'] 
-      
-      expected_prop = expected['proportion']
-      expected_pos = expected['position']
-
-      # Find matching found mutation
-      found = compare_indels(region, pos, alt_base, found_mutations, reference_sequence)
-      if found is not None:
-          found_freq = found['ALT_FREQ']
-          results.append({
-              'region': found['REGION'],
-              'found_pos': found['POS'],
-              'expected_pos': expected_pos,
-              'expected_alt': alt_base,
-              'expected_prop': expected_prop,
-              'found_alt': found['ALT'],
-              'found_freq': found_freq
-          })
-      else:
-          results.append({
-              'region': region,
-              'found_pos': pos,
-              'expected_pos': expected_pos,
-              'expected_alt': alt_base,
-              'expected_prop': expected_prop,
-              'found_alt': None,
-              'found_freq': 0
-          })
-
-  # Track unmatched found mutations
-  matched_positions = set((row['found_pos'], row['found_alt']) for row in results if row['found_alt'] is not None)
-  unmatched_found = found_mutations[~found_mutations.apply(lambda row: (row['POS'], row['ALT']) in matched_positions, axis=1)]
-
-  # Add unmatched found mutations to results
-  for _, found in unmatched_found.iterrows():
-      results.append({
-          'region': found['REGION'],
-          'found_pos': found['POS'],
-          'expected_pos': None,
-          'expected_alt': None,
-          'expected_prop': 0,
-          'found_alt': found['ALT'],
-          'found_freq': found['ALT_FREQ']
-      })
-    
+  with metrics.phase("match"):
+    # Prepare a DataFrame for results
+    results = []
+    found_regions = found_mutations['REGION'].to_numpy()
+    found_positions = found_mutations['POS'].to_numpy()
+    found_alts = found_mutations['ALT'].to_numpy()
+    found_freqs = found_mutations['ALT_FREQ'].to_numpy()
+
+    # Compare SNPs: join on (region, pos, alt), the first found row is kept
+    found_keys = found_mutations[['REGION', 'POS', 'ALT']].assign(found_row=range(len(found_mutations)))
+    found_keys = found_keys.drop_duplicates(subset=['REGION', 'POS', 'ALT'])
+    matched_snps = expected_snps.merge(found_keys, how='left', left_on=['region', 'position', 'alt_base'],
+      right_on=['REGION', 'POS', 'ALT'])
+    for region, pos, alt_base, expected_prop, found_row in zip(matched_snps['region'], matched_snps['position'],
+        matched_snps['alt_base'], matched_snps['proportion'], matched_snps['found_row']):
+        if pd.notna(found_row):
+            found_row = int(found_row)
+            results.append({
+                'region': found_regions[found_row],
+                'found_pos': found_positions[found_row],
+                'expected_pos': pos,
+                'expected_alt': alt_base,
+                'expected_prop': expected_prop,
+                'found_alt': found_alts[found_row],
+                'found_freq': found_freqs[found_row]
+            })
+        else:
+            results.append({
+                'region': region,
+                'found_pos': None,
+                'expected_pos': pos,
+                'expected_alt': alt_base,
+                'expected_prop': expected_prop,
+                'found_alt': None,
+                'found_freq': 0
+            })
+
+    # Compare Indels: join on the canonical (left-normalized) form
+    indel_index = index_indels(found_mutations, reference)
+    for region, pos, indel_type, sequence, expected_prop in zip(expected_indels['region'], expected_indels['position'],
+        expected_indels['type'], expected_indels['sequence'], expected_indels['proportion']):
+        alt_base = sequence
+        if indel_type == "insertion":
+          alt_base = "+" + sequence
+        if indel_type == "deletion":
+          alt_base = "-" + sequence
+
+        # Find matching found mutation
+        found_row = compare_indels(region, pos, alt_base, indel_index, reference)
+        if found_row is not None:
+            results.append({
+                'region': found_regions[found_row],
+                'found_pos': found_positions[found_row],
+                'expected_pos': pos,
+                'expected_alt': alt_base,
+                'expected_prop': expected_prop,
+                'found_alt': found_alts[found_row],
+                'found_freq': found_freqs[found_row]
+            })
+        else:
+            results.append({
+                'region': region,
+                'found_pos': pos,
+                'expected_pos': pos,
+                'expected_alt': alt_base,
+                'expected_prop': expected_prop,
+                'found_alt': None,
+                'found_freq': 0
+            })
+
+    # Track unmatched found mutations
+    matched_positions = set((row['found_pos'], row['found_alt']) for row in results if row['found_alt'] is not None)
+    is_matched = pd.MultiIndex.from_arrays([found_positions, found_alts]).isin(list(matched_positions))
+
+    # Add unmatched found mutations to results
+    for found_row in (~is_matched).nonzero()[0]:
+        results.append({
+            'region': found_regions[found_row],
+            'found_pos': found_positions[found_row],
+            'expected_pos': None,
+            'expected_alt': None,
+            'expected_prop': 0,
+            'found_alt': found_alts[found_row],
+            'found_freq': found_freqs[found_row]
+        })
+
   # Create a DataFrame from results
+  with metrics.phase("results"):
+    results_df = format_results(results)
+  return results_df
+
+def format_results(results):
+  """DataFrame of the result rows sorted by found position, proportions in %"""
   results_df = pd.DataFrame(results)
   results_df['diff_prop'] = results_df['expected_prop'] - results_df['found_freq']
   results_df.sort_values(by='found_pos', ascending=True, inplace=True)
@@ -157,6 +247,25 @@ def compare_mutations(expected_indel_file, expected_snp_file, found_file, refere
   results_df['expected_prop'] = results_df['expected_prop'].apply(lambda x: round(x * 100, 2) if pd.notnull(x) else x)
   results_df['found_freq'] = results_df['found_freq'].apply(lambda x: round(x * 100, 2) if pd.notnull(x) else x)
   results_df['diff_prop'] = results_df['diff_prop'].apply(lambda x: round(x * 100, 2) if pd.notnull(x) else x)
+  return results_df
+
+def typed_results(results_df):
+  """
+  Results in a single table: within_tolerance is True for the rows written to
+  stdout (|diff_prop| < 2) and False for the ones written to stderr (whether
+  the mutation was found or not is given by found_alt), positions are
+  nullable integers.
+  """
+  typed_df = results_df.assign(within_tolerance=results_df['diff_prop'].abs() < 2)
+  for column in ('found_pos', 'expected_pos'):
+    typed_df[column] = pd.to_numeric(typed_df[column]).astype('Int64')
+  return typed_df
+
+def write_results(results_df, out=None, out_format=None):
+  if out:
+    write_table(typed_results(results_df), out, out_format)
+    return
+
   # Output to stdout and stderr based on diff_prop
   stdout_df = results_df[results_df['diff_prop'].abs() < 2]
   stderr_df = results_df[results_df['diff_prop'].abs() >= 2]
@@ -167,17 +276,153 @@ def compare_mutations(expected_indel_file, expected_snp_file, found_file, refere
   # Output to stderr
   stderr_df.to_csv(sys.stderr, sep='\t', index=False)
 
+def summarize_results(results_df):
+  """Count matched / expected mutations by kind, unexpected found ones and proportions off by >= 2%"""
+  is_expected = results_df['expected_alt'].notna()
+  is_indel = is_expected & results_df['expected_alt'].astype(str).str[0].isin(["+", "-"])
+  is_snp = is_expected & ~is_indel
+  is_matched = results_df['found_alt'].notna()
+  return {
+    'snp_expected': int(is_snp.sum()),
+    'snp_matched': int((is_snp & is_matched).sum()),
+    'indel_expected': int(is_indel.sum()),
+    'indel_matched': int((is_indel & is_matched).sum()),
+    'unexpected': int((~is_expected).sum()),
+    'off_prop': int((results_df['diff_prop'].abs() >= 2).sum())
+  }
+
+def file_hash(path):
+  digest = hashlib.sha256()
+  with open(path, 'rb') as f:
+    for block in iter(lambda: f.read(1 << 20), b""):
+      digest.update(block)
+  return digest.hexdigest()
+
+def find_batch_samples(expected_dir, found_dir, found_suffix):
+  """
+  List the (sample, indel file, snp file, found file) of a batch.
+
+  Expected results are <expected_dir>/<sample>.snp.csv and <sample>.indel.csv,
+  the found mutations <found_dir>/[<prefix>_]<sample><found_suffix> (e.g.
+  var_batch_filtered/batch1_batchFiltered/b1_P0_corrected_batchFiltered.tsv).
+  """
+  samples = []
+  for snp_file in sorted(glob.glob(os.path.join(expected_dir, "*.snp.csv"))):
+    sample = os.path.basename(snp_file)[:-len(".snp.csv")]
+    indel_file = os.path.join(expected_dir, sample + ".indel.csv")
+    found_files = [path for path in glob.glob(os.path.join(found_dir, "*" + sample + found_suffix))
+      if os.path.basename(path) == sample + found_suffix or os.path.basename(path).endswith("_" + sample + found_suffix)]
+    if len(found_files) != 1 or not os.path.exists(indel_file):
+      print(f"Warning: skipping sample {sample}: missing indel file or not exactly one found file ({len(found_files)})", file=sys.stderr)
+      continue
+    samples.append((sample, indel_file, snp_file, found_files[0]))
+  return samples
+
+_batch = dict()
+
+def init_batch_worker(reference):
+  _batch["reference"] = reference
+
+def check_sample(sample):
+  """Summary row of a sample and its metrics (added to the metrics of the parent process)"""
+  name, indel_file, snp_file, found_file, input_hash = sample
+  snapshot = metrics.snapshot()
+  results_df = compare_mutations(indel_file, snp_file, found_file, _batch["reference"])
+  return {'sample': name, **summarize_results(results_df), 'input_hash': input_hash}, metrics.since(snapshot)
+
+def run_batch(args):
+  """
+  Check all the samples of a batch against a shared reference and write one
+  summary table. Samples whose inputs (and reference) are unchanged since the
+  summary was last written are not checked again.
+  """
+  samples = find_batch_samples(args.batch, args.found_dir, args.found_suffix)
+  previous = {}
+  if os.path.exists(args.summary):
+    previous_df = read_table(args.summary, args.out_format, dtype={'sample': str})
+    previous = {row['sample']: row for row in previous_df.to_dict('records')}
+
+  rows = {}
+  to_check = []
+  with metrics.phase("hash"):
+    reference_hash = file_hash(args.reference)
+    for name, indel_file, snp_file, found_file in samples:
+      digest = hashlib.sha256(reference_hash.encode())
+      for path in (indel_file, snp_file, found_file):
+        digest.update(file_hash(path).encode())
+      input_hash = digest.hexdigest()
+      if name in previous and previous[name]['input_hash'] == input_hash:
+        rows[name] = previous[name]
+      else:
+        to_check.append((name, indel_file, snp_file, found_file, input_hash))
+  metrics.count("samples_checked", len(to_check))
+  metrics.count("samples_skipped", len(samples) - len(to_check))
+  print(f"{len(samples) - len(to_check)} unchanged samples, {len(to_check)} to check", file=sys.stderr)
+
+  if to_check:
+    with metrics.phase("read_reference"):
+      reference = read_reference(args.reference)
+    with metrics.phase("check"):
+      if args.threads > 1:
+        with ProcessPoolExecutor(max_workers=args.threads, initializer=init_batch_worker, initargs=(reference,)) as executor:
+          checked = list(executor.map(check_sample, to_check))
+        for _, task in checked:
+          metrics.add_task(task)
+      else:
+        init_batch_worker(reference)
+        checked = list(map(check_sample, to_check))
+    for row, _ in checked:
+      rows[row['sample']] = row
+
+  with metrics.phase("write"):
+    summary_df = pd.DataFrame([rows[name] for name, _, _, _ in samples])
+    write_table(summary_df, args.summary, args.out_format)
 
 def main():
   parser = argparse.ArgumentParser(description='Compare expected mutations with found mutations.')
-  parser.add_argument('expected_indel_file', type=str, help='Path to the expected indel mutations file (CSV)')
-  parser.add_argument('expected_snp_file', type=str, help='Path to the expected SNP mutations file (CSV)')
-  parser.add_argument('found_file', type=str, help='Path to the found mutations file (TSV)')
-  parser.add_argument('reference_file', type=str, help='Path to the reference sequence file (FASTA)')
+  parser.add_argument('expected_indel_file', type=str, nargs='?', help='Path to the expected indel mutations file (CSV)')
+  parser.add_argument('expected_snp_file', type=str, nargs='?', help='Path to the expected SNP mutations file (CSV)')
+  parser.add_argument('found_file', type=str, nargs='?', help='Path to the found mutations file (TSV)')
+  parser.add_argument('reference_file', type=str, nargs='?', help='Path to the reference sequence file (FASTA)')
+  parser.add_argument('--batch', type=str, metavar='EXPECTED_DIR',
+    help='Batch mode: directory of the expected results of a batch (expected_results/<batch>)')
+  parser.add_argument('--found_dir', type=str,
+    help='Batch mode: directory of the found mutations of the batch (var_batch_filtered/<batch>_batchFiltered)')
+  parser.add_argument('--found_suffix', type=str, default='_corrected_batchFiltered.tsv',
+    help='Batch mode: suffix of the found mutations files after the sample name')
+  parser.add_argument('--reference', type=str, help='Batch mode: path to the reference sequence file (FASTA)')
+  parser.add_argument('--summary', type=str, default='check_results_summary.tsv',
+    help='Batch mode: summary table (TSV, Parquet or Arrow), also used to skip unchanged samples')
+  parser.add_argument('--out', type=str, default=None,
+    help='Write all the results to this table with a within_tolerance column (True for the rows otherwise written' +
+    ' to stdout, False for the ones written to stderr) instead of stdout / stderr')
+  parser.add_argument('--out_format', choices=TABLE_FORMATS, default=None,
+    help='Format of --out and --summary: TSV, Parquet or Arrow IPC (requires pyarrow) with typed columns' +
+    ' (default: from the extension, .parquet, .arrow or TSV otherwise)')
+  parser.add_argument('--threads', type=int, default=1, help='Batch mode: number of samples checked in parallel')
+  parser.add_argument('--metrics_json', type=str, default=None,
+    help='Write the wall / CPU time of each phase, the peak RSS and counters (rows, samples) to this JSON file')
+  parser.add_argument('--profile', type=str, default=None, help='Write cProfile stats of the run to this file')
 
   args = parser.parse_args()
+  if args.profile:
+    metrics.start_profile()
+
+  if args.batch:
+    if not args.found_dir or not args.reference:
+      parser.error("--batch requires --found_dir and --reference")
+    run_batch(args)
+    metrics.write(args.metrics_json, args.profile)
+    return
 
-  compare_mutations(args.expected_indel_file, args.expected_snp_file, args.found_file, args.reference_file)
+  if not all([args.expected_indel_file, args.expected_snp_file, args.found_file, args.reference_file]):
+    parser.error("expected_indel_file, expected_snp_file, found_file and reference_file are required")
+  with metrics.phase("read_reference"):
+    reference = read_reference(args.reference_file)
+  results_df = compare_mutations(args.expected_indel_file, args.expected_snp_file, args.found_file, reference)
+  with metrics.phase("write"):
+    write_results(results_df, args.out, args.out_format)
+  metrics.write(args.metrics_json, args.profile)
 
 if __name__ == '__main__':
-  main()
\ No newline at end of file
+  main()
@@ -0,0 +1,228 @@
+#!/usr/bin/env python3
+
+"""
+Alignment backends and scoring presets shared by the scripts.
+
+A scoring preset is a named set of PairwiseAligner settings (global mode):
+  - coords: assemblies vs references (align_coords.py), end gaps are free
+  - annot: contig vs contig (transfer_annot.py), end gaps are penalized
+The alignment cache keys include the scoring settings, so entries are only
+shared between runs using the same preset.
+
+A backend (--engine) scores and aligns pairs with a preset:
+  - biopython: PairwiseAligner.score and PairwiseAligner.align, alignments
+    whose traceback exceeds the memory budget are computed in linear memory
+    (see linear_align.py)
+  - numpy: scores computed by anti-diagonals (wavefront) in numpy, each
+    anti-diagonal being independent in the affine gap DP, alignments always
+    computed in linear memory. It is a pure numpy reference implementation
+    to cross-check biopython, not a faster engine: its scores are about 4x
+    slower than PairwiseAligner.score (1.1 s vs 0.3 s for 8 kb pairs) and
+    its alignments are always computed in linear memory (about 20 s for
+    20 kb pairs), so biopython (the default) is the one to use for runs
+
+The fast numpy scores are the banded ones (banded_scores, align_coords.py
+--screen_band): the affine gap DP of a target against several queries at
+once, by rows, restricted to the cells within band columns of the diagonal
+from the start to the end of both sequences. Each row is computed for all
+the queries with a few numpy operations on (queries, band) arrays, so the
+cost grows with the target length instead of the number of cells (0.2 s per
+pair vs 0.95 s for PairwiseAligner.score, 12.5 kb target vs 5 queries, band
+64). A banded score is the best score of the alignments inside the band, a
+lower bound of the optimal score (equal when the optimal alignment stays in
+the band, e.g. complete segments with few indels): they are only used to
+screen the candidates of phase 1, whose top ones are then scored exactly by
+the backend.
+
+Both backends return the same optimal scores, the coordinates may differ
+among co-optimal alignments. data/bench/check_backends.py checks the
+agreement of the backends on synthetic pairs.
+
+  backend = get_backend("numpy", "coords", max_memory)
+  score = backend.score(target, query)
+  best = next(iter(backend.align(target, query)), None)
+"""
+
+import numpy as np
+from Bio.Align import PairwiseAligner
+from linear_align import check_gap_scores, gap_scores, global_align, linear_align, dp_memory
+
+SCORING_PRESETS = {
+  "coords": {
+    "match_score": 2.0,
+    "mismatch_score": -1.0,
+    "open_gap_score": -10.0,
+    "extend_gap_score": -0.5,
+    "target_end_gap_score": 0.0,
+    "query_end_gap_score": 0.0
+  },
+  "annot": {
+    "match_score": 5,
+    "mismatch_score": -4,
+    "open_gap_score": -10,
+    "extend_gap_score": -0.5,
+    "target_end_gap_score": -5,
+    "query_end_gap_score": -5
+  }
+}
+
+ENGINES = ["biopython", "numpy"]
+
+def make_aligner(scoring):
+  """PairwiseAligner in global mode with the settings of a scoring preset"""
+  aligner = PairwiseAligner()
+  aligner.mode = "global"
+  for name, value in SCORING_PRESETS[scoring].items():
+    setattr(aligner, name, value)
+  return aligner
+
+def wavefront_score(aligner, target, query):
+  """
+  Global alignment score of target and query with the aligner settings,
+  computed by anti-diagonals (d = i + j) in linear memory.
+  """
+  if aligner.mode != "global" or aligner.substitution_matrix is not None:
+    raise ValueError("The wavefront engine only supports the global mode with match / mismatch scores")
+  # a gap may be closed and reopened at once in the anti-diagonal DP too
+  check_gap_scores(aligner)
+  # letters and gap scores are shifted by one so that index i (or j) is the
+  # letter before DP row i (column j)
+  target_letters = np.concatenate([[0], np.frombuffer(str(target).encode(), dtype=np.uint8)])
+  query_letters = np.concatenate([[0], np.frombuffer(str(query).encode(), dtype=np.uint8)])
+  n, m = len(target_letters) - 1, len(query_letters) - 1
+  # gaps in the target (along j) are scored by row, in the query (along i) by column
+  h_open, h_extend = gap_scores(aligner, "target", n)
+  v_open, v_extend = gap_scores(aligner, "query", m)
+
+  # H, D (vertical) and I (horizontal) of the anti-diagonals d - 1 and d - 2,
+  # indexed by i + 1 (index 0 and the cells next to a diagonal are -inf)
+  h_1, d_1, i_1 = (np.full(n + 3, -np.inf) for _ in range(3))
+  h_2 = np.full(n + 3, -np.inf)
+  h_1[1] = 0.0
+  for d in range(1, n + m + 1):
+    lo, hi = max(0, d - m), min(n, d)
+    j = d - np.arange(lo, hi + 1)
+    vertical = np.maximum(h_1[lo:hi + 1] + v_open[j], d_1[lo:hi + 1] + v_extend[j])
+    horizontal = np.maximum(h_1[lo + 1:hi + 2] + h_open[lo:hi + 1], i_1[lo + 1:hi + 2] + h_extend[lo:hi + 1])
+    substitution = np.where(target_letters[lo:hi + 1] == query_letters[j], aligner.match_score, aligner.mismatch_score)
+    best = np.maximum(np.maximum(h_2[lo:hi + 1] + substitution, vertical), horizontal)
+    # the buffers of d - 2 become the ones of d
+    h_2, h_1 = h_1, h_2
+    h_1[lo + 1:hi + 2] = best
+    h_1[lo] = h_1[hi + 2] = -np.inf
+    d_1[lo + 1:hi + 2] = vertical
+    d_1[lo] = d_1[hi + 2] = -np.inf
+    i_1[lo + 1:hi + 2] = horizontal
+    i_1[lo] = i_1[hi + 2] = -np.inf
+  return float(h_1[n + 1])
+
+def banded_scores(aligner, target, queries, band):
+  """
+  Banded global alignment scores of target against each query with the
+  aligner settings (match / mismatch scores). For a query of length m (target
+  length n), only the cells within band columns of the diagonal from (0, 0)
+  to (n, m) are computed: |j - (i * m) // n| <= band.
+  """
+  if aligner.mode != "global" or aligner.substitution_matrix is not None:
+    raise ValueError("The banded scores only support the global mode with match / mismatch scores")
+  if band < 1:
+    raise ValueError("The band of the banded scores must be at least 1")
+  check_gap_scores(aligner)
+  target_letters = np.frombuffer(str(target).encode(), dtype=np.uint8)
+  n = max(len(target_letters), 1)
+  lengths = np.array([len(query) for query in queries])
+  width = 2 * band + 1
+  rows = np.arange(len(queries))[:, None]
+  offsets = np.arange(width)
+
+  # Column data at index j + band (columns -band .. m + band): gap scores of
+  # the column, substitution scores of the letter before it for each target
+  # letter and -inf outside the query (0 inside)
+  n_positions = int(lengths.max()) + 2 * band + 1
+  v_open = np.zeros((len(queries), n_positions))
+  v_extend = np.zeros((len(queries), n_positions))
+  outside = np.full((len(queries), n_positions), -np.inf)
+  substitutions = {letter: np.full((len(queries), n_positions), aligner.mismatch_score)
+    for letter in set(target_letters.tolist())}
+  for idx, query in enumerate(queries):
+    columns = slice(band, band + lengths[idx] + 1)
+    v_open[idx, columns], v_extend[idx, columns] = gap_scores(aligner, "query", lengths[idx])
+    outside[idx, columns] = 0.0
+    query_letters = np.frombuffer(str(query).encode(), dtype=np.uint8)
+    for letter, scores in substitutions.items():
+      scores[idx, band + 1:band + 1 + lengths[idx]][query_letters == letter] = aligner.match_score
+  windows = lambda array: np.lib.stride_tricks.sliding_window_view(array, width, axis=1)
+  v_open, v_extend, outside = windows(v_open), windows(v_extend), windows(outside)
+  substitutions = {letter: windows(scores) for letter, scores in substitutions.items()}
+  h_open, h_extend = gap_scores(aligner, "target", len(target_letters))
+
+  def horizontal(h_diag, row):
+    # I[k] = max over l < k of h_diag[l] + open + (k - l - 1) * extend (see linear_align)
+    extend = max(h_open[row], h_extend[row])
+    gaps = np.full(h_diag.shape, -np.inf)
+    gaps[:, 1:] = h_open[row] + (offsets[1:] - 1) * extend + \
+      np.maximum.accumulate(h_diag - offsets * extend, axis=1)[:, :-1]
+    return gaps
+
+  # cell k of row i is the column start_i + k, start_i = (i * m) // n - band
+  # (stored at index start_i + band of the column data)
+  starts = np.zeros(len(queries), dtype=np.int64)
+  h_diag = np.full((len(queries), width), -np.inf)
+  h_diag[:, band] = 0.0
+  h = np.maximum(h_diag, horizontal(h_diag, 0)) + outside[rows[:, 0], starts]
+  d = np.full(h.shape, -np.inf)
+  # previous row padded with -inf: index k + 1 is the cell k
+  padded_h = np.full((len(queries), 2 * width + 2), -np.inf)
+  padded_d = np.full((len(queries), 2 * width + 2), -np.inf)
+  for row in range(1, len(target_letters) + 1):
+    previous_starts = starts
+    starts = row * lengths // n
+    # the cell above (same column) of the cell k is the cell k + shift of the
+    # previous row, the diagonal one the cell k + shift - 1 (out of the band
+    # if the shift is larger than the band)
+    shift = np.minimum(starts - previous_starts, width + 1)[:, None]
+    padded_h[:, 1:width + 1] = h
+    padded_d[:, 1:width + 1] = d
+    above = offsets + shift + 1
+    h_above = np.take_along_axis(padded_h, above, axis=1)
+    d = np.maximum(h_above + v_open[rows[:, 0], starts], np.take_along_axis(padded_d, above, axis=1) +
+      v_extend[rows[:, 0], starts])
+    h_diag = np.maximum(np.take_along_axis(padded_h, above - 1, axis=1) +
+      substitutions[target_letters[row - 1]][rows[:, 0], starts], d)
+    h = np.maximum(h_diag, horizontal(h_diag, row)) + outside[rows[:, 0], starts]
+  return h[:, band].tolist()
+
+class BiopythonBackend:
+  """PairwiseAligner scores and alignments (linear memory above max_memory bytes)"""
+
+  name = "biopython"
+
+  def __init__(self, scoring, max_memory=None):
+    self.scoring = scoring
+    self.aligner = make_aligner(scoring)
+    self.max_memory = max_memory
+
+  def score(self, target, query):
+    return self.aligner.score(target, query)
+
+  def align(self, target, query):
+    """Co-optimal alignments, best first (only the best one in linear memory)"""
+    if self.max_memory is None or dp_memory(target, query) <= self.max_memory:
+      return self.aligner.align(target, query)
+    return [global_align(self.aligner, target, query, self.max_memory)]
+
+class NumpyBackend(BiopythonBackend):
+  """Wavefront scores and linear memory alignments in numpy"""
+
+  name = "numpy"
+
+  def score(self, target, query):
+    return wavefront_score(self.aligner, target, query)
+
+  def align(self, target, query):
+    return [linear_align(self.aligner, target, query)]
+
+def get_backend(engine, scoring, max_memory=None):
+  """Backend of an engine (ENGINES) with a scoring preset (SCORING_PRESETS)"""
+  backends = {backend.name: backend for backend in (BiopythonBackend, NumpyBackend)}
+  return backends[engine](scoring, max_memory)
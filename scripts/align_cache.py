@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+
+"""
+Persistent on-disk cache of pairwise alignments.
+
+Entries are keyed by a hash of both sequences (in aligner order, so the
+orientation of the query is part of the key), all the PairwiseAligner scoring
+settings and the alignment mode. An entry holds the alignment score and, when
+the traceback was computed, its coordinates.
+
+Each entry is a .npz file in the cache directory. Writes are atomic so the
+cache can be shared by concurrent processes. The least recently used entries
+(by modification time, refreshed on each hit) are evicted when the total size
+exceeds the size cap, down to EVICT_TARGET of the cap. The total size is
+scanned once by the first put of a process then kept up to date with the
+sizes written, so a put does not list the cache directory. The entries
+written by other processes are only counted at the next scan (eviction), so
+concurrent processes may exceed the cap by their own writes until then.
+"""
+
+import os
+import hashlib
+import tempfile
+import numpy as np
+
+# Fraction of the size cap left after an eviction (so that evictions, which
+# scan the cache directory, are not run on every put once the cache is full)
+EVICT_TARGET = 0.9
+
+def mode_tag(align_mode, anchor_size):
+  """Part of the key for the alignment mode (anchored alignments depend on the anchor size)"""
+  return f"{align_mode}:{anchor_size}" if align_mode == "anchored" else align_mode
+
+class AlignmentCache:
+  """Alignment cache in cache_dir limited to max_size_mb megabytes"""
+
+  def __init__(self, cache_dir, max_size_mb=1024):
+    self.cache_dir = cache_dir
+    self.max_size = max_size_mb * 1024 * 1024
+    # Estimated total size of the entries, scanned on the first put
+    self.total_size = None
+    os.makedirs(cache_dir, exist_ok=True)
+
+  def key(self, aligner, target, query, mode=""):
+    """Return the key of the alignment of target vs query with aligner"""
+    digest = hashlib.sha256()
+    for item in (str(target), str(query), str(aligner), mode):
+      digest.update(item.encode())
+      digest.update(b"\0")
+    return digest.hexdigest()
+
+  def _path(self, key):
+    return os.path.join(self.cache_dir, f"{key}.npz")
+
+  def get(self, key, need_coordinates=True):
+    """
+    Return (score, coordinates) of a cached alignment, coordinates is None for
+    a score-only entry. Return None if the entry is missing (or has no
+    coordinates while they are needed).
+    """
+    path = self._path(key)
+    try:
+      with np.load(path) as entry:
+        score = float(entry["score"])
+        coordinates = entry["coordinates"] if "coordinates" in entry else None
+      os.utime(path)
+    except (FileNotFoundError, OSError, ValueError, KeyError):
+      return None
+    if need_coordinates and coordinates is None:
+      return None
+    return score, coordinates
+
+  def put(self, key, score, coordinates=None):
+    """Store an alignment score (and coordinates) then evict old entries if needed"""
+    path = self._path(key)
+    try:
+      replaced_size = os.stat(path).st_size
+    except FileNotFoundError:
+      replaced_size = 0
+    if coordinates is None and replaced_size:
+      # Do not replace a full entry by a score-only one
+      return
+    arrays = {"score": np.float64(score)}
+    if coordinates is not None:
+      arrays["coordinates"] = np.asarray(coordinates)
+    fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix=".tmp")
+    with os.fdopen(fd, "wb") as f:
+      np.savez(f, **arrays)
+      size = f.tell()
+    os.replace(tmp_path, path)
+    if self.total_size is None:
+      self.total_size = self._scan()[1]
+    else:
+      self.total_size += size - replaced_size
+    if self.total_size > self.max_size:
+      self.evict()
+
+  def _scan(self):
+    """Return the entries (mtime, size, path) of the cache directory and their total size"""
+    entries = []
+    for entry in os.scandir(self.cache_dir):
+      if entry.name.endswith(".npz"):
+        try:
+          stat = entry.stat()
+        except FileNotFoundError:
+          continue
+        entries.append((stat.st_mtime, stat.st_size, entry.path))
+    return entries, sum(size for _, size, _ in entries)
+
+  def evict(self):
+    """Remove the least recently used entries until the cache fits in EVICT_TARGET of its size cap"""
+    entries, total_size = self._scan()
+    if total_size > self.max_size:
+      for _, size, path in sorted(entries):
+        if total_size <= self.max_size * EVICT_TARGET:
+          break
+        try:
+          os.remove(path)
+        except FileNotFoundError:
+          pass
+        total_size -= size
+    self.total_size = total_size
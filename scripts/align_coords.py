@@ -2,14 +2,25 @@
 
 import sys
 import os
+import json
+import hashlib
 import argparse
 from Bio import SeqIO
-from Bio.Align import PairwiseAligner
+from Bio.Align import Alignment
 from Bio.Seq import Seq
+from Bio.SeqRecord import SeqRecord
 import pandas as pd
 import numpy as np
-import json
 from pathlib import Path
+from functools import lru_cache
+from concurrent.futures import ProcessPoolExecutor
+from anchored_align import ALIGN_MODES, anchored_align
+from align_backends import ENGINES, SCORING_PRESETS, banded_scores, get_backend
+from coords_io import write_coords_bin, write_coords_json
+from align_cache import AlignmentCache, mode_tag
+from aln_report import write_alignment_blocks
+from run_metrics import metrics
+from ref_index import RefIndex, minimizer_hashes, open_sequences
 
 DOCS = """
 Transfer annotations between sequence sets.
@@ -17,23 +28,70 @@ Two input multi fasta are aligned using a global gapped alignment algorithm.
 Queries and targers input are expectec to have 1-to-1 relationship, i.e. the 
 same number of sequences in each file.
 
-Queries are processed 1-by-1 to match a query to a target:
-  - Each query is aligned vs all targets
-  - Both query seq and reverse complement is considered for the alignment
-  - The target with the best alignment score is selected as the match
-  - This target is no longer included for the next queries
+Queries are matched to targets in two phases:
+  - Optionally (--top_k > 0), a minimizer sketch of the query (and of its 
+    reverse complement) is compared to the sketches of all targets and only 
+    the top-k (target, strand) candidates are aligned. If the sketch is 
+    ambiguous, all targets are aligned.
+  - Optionally (--screen_band > 0), the (candidate) pairs are first scored
+    in numpy within a band of diagonals, a query strand against all its
+    candidate targets at once (a lower bound of the score, linear in the
+    sequence length for a fixed band, see align_backends.py), and only the
+    --screen_top best (target, strand) of each query are kept for phase 1.
+  - Phase 1: alignment scores (without traceback) of each query vs all 
+    (candidate) targets. Both query seq and reverse complement are considered.
+  - Phase 2: assignment of targets to queries
+    - optimal (default): the 1-to-1 assignment maximizing the total score 
+      (Hungarian method)
+    - greedy: queries are processed 1-by-1, the target with the best score is
+      selected as the match and is no longer included for the next queries
+  - The alignments (with traceback) are computed only for the matched pairs
+  - With --align_mode anchored, the global alignment is only computed between
+    chained exact k-mer anchors (fast for long and similar sequences)
+  - The exhaustive scores and alignments are computed by the --engine backend
+    with the --scoring preset (see align_backends.py)
+  - Alignments whose traceback matrix would exceed --max_memory are computed
+    in linear memory (Hirschberg), same optimal score, see linear_align.py
+  - With --threads > 1, the alignments are run in a process pool (results are
+    identical to the serial run)
+  - With --cache_dir, scores and alignments are stored in a persistent cache
+    (keyed by the sequences and the scoring parameters) and reused by later
+    runs
+  - With --metrics_json, the time of each phase (read_fasta, sketch, score,
+    traceback, stats, write_report, ...), the peak RSS and counters (scored
+    and aligned pairs, DP cells) are written as JSON, see run_metrics.py
+  - Each computed score (query, target, orientation, score) and each
+    matched pair (with its coordinates) is recorded in the append-only
+    journal <out_dir>/coords.journal as soon as it is computed. With
+    --resume, the journal of an interrupted run (same sequence ids, lengths
+    and contents, same settings) is reused: its scores are not computed
+    again, its matched queries are not aligned again (their targets are
+    removed from the available ones) and the outputs are assembled from the
+    journal and the pairs aligned by this run
+
+Sequences are read from the fasta files when needed through a samtools faidx
+index (<fasta>.fai, reused or created), so only the sequences being aligned
+are in memory. If a fasta has an up to date reference index (<fasta>.vvi,
+built with `ref_index.py build`), sequences, reverse complements and sketches
+(same --kmer_size and --window_size) are read from its memory map instead.
 
 Coordinates mapping from query to target are defined based on the alignment and
 written in json format.
 
 Outputs:
-  - json files with all mappings <out_dir>/coords.json
+  - binary file with all mappings <out_dir>/coords.bin (--coords_format bin 
+    or both), int32 coordinates blocks indexed by (query_id, target_id), see
+    coords_io.py for the layout and the CoordsFile reader.
+  - json files with all mappings <out_dir>/coords.json (--coords_format json
+    or both)
     mappings are a list of match with ids a list of matched sequence.
     "ids": [query_id, target_id].
     "coords": coordinates frmo the alignment. 
   - reoriented queries in <out_dir>/<queries.basename>.reoriented.fasta
   - aln files for each match: 
     <out_dir>/<queries.basename>_<query_id>_<targets.basename>_<target.id>.aln
+    the alignment is streamed by blocks of 60 columns in the layout of the
+    Biopython alignment text (see aln_report.py)
 
 """
 
@@ -43,28 +101,345 @@ def parse_arguments():
   parser.add_argument('--targets', required=True, help='Input multifasta file 2')
   parser.add_argument('--min_identity', type=float, default=0.85, help='Minimum identity threshold')
   parser.add_argument('--out_dir', default=".", help='Output directory')
+  parser.add_argument('--top_k', type=int, default=0,
+    help='Number of (target, strand) candidates kept by the minimizer sketch\n' +
+    'prefilter for full alignment (0: exhaustive search, default)')
+  parser.add_argument('--kmer_size', type=int, default=15, help='k-mer size for the minimizer sketch')
+  parser.add_argument('--window_size', type=int, default=10, help='Window size (in k-mers) for the minimizer sketch')
+  parser.add_argument('--ambiguity_ratio', type=float, default=0.9,
+    help='Fall back to exhaustive search if a candidate beyond the top-k\n' +
+    'reaches this fraction of the best sketch score')
+  parser.add_argument('--screen_band', type=int, default=0,
+    help='Screen the candidates by banded wavefront scores with this band\n' +
+    '(diagonals on each side of the sequence ends), 0: no screening (default)')
+  parser.add_argument('--screen_top', type=int, default=2,
+    help='Number of (target, strand) candidates of each query kept by the\n' +
+    'screening and scored exactly')
+  parser.add_argument('--threads', type=int, default=1, help='Number of processes used for the alignments')
+  parser.add_argument('--align_mode', choices=ALIGN_MODES, default="exhaustive",
+    help='exhaustive: full global alignment\n' +
+    'anchored: global alignment between chained exact k-mer anchors')
+  parser.add_argument('--anchor_size', type=int, default=15, help='k-mer size of anchors for the anchored mode')
+  parser.add_argument('--assignment', choices=["optimal", "greedy"], default="optimal",
+    help='optimal: 1-to-1 assignment maximizing the total alignment score\n' +
+    'greedy: each query (in input order) takes its best available target')
+  parser.add_argument('--coords_format', choices=["bin", "json", "both"], default="bin",
+    help='Format of the coordinates mappings output (coords.bin and/or coords.json)')
+  parser.add_argument('--cache_dir', default=None, help='Directory of the persistent alignment cache (disabled by default)')
+  parser.add_argument('--cache_max_size', type=float, default=1024,
+    help='Size cap of the alignment cache in MB, least recently used entries\n' +
+    'are evicted above')
+  parser.add_argument('--engine', choices=ENGINES, default="biopython",
+    help='biopython: PairwiseAligner scores and alignments\n' +
+    'numpy: wavefront scores and linear memory alignments in pure numpy,\n' +
+    'same scores but several times slower, to cross-check biopython\n' +
+    '(see align_backends.py)')
+  parser.add_argument('--scoring', choices=list(SCORING_PRESETS), default="coords",
+    help='Scoring preset shared with transfer_annot.py (see align_backends.py)')
+  parser.add_argument('--max_memory', type=float, default=4096,
+    help='Memory budget in MB of the traceback of an alignment, larger\n' +
+    'alignments are computed in linear memory (slower)')
+  parser.add_argument('--resume', action='store_true',
+    help='Reuse the scores and matched pairs recorded in <out_dir>/coords.journal\n' +
+    'by an interrupted run with the same inputs and settings')
+  parser.add_argument('--metrics_json', default=None,
+    help='Write the wall / CPU time of each phase, the peak RSS and counters\n' +
+    '(aligned pairs, DP cells) to this JSON file')
+  parser.add_argument('--profile', default=None, help='Write cProfile stats of the run to this file')
   return parser.parse_args()
 
-def setup_aligner():
-  """Configure and return a PairwiseAligner object for local gapped alignment"""
-  aligner = PairwiseAligner()
-  
-  # Set alignment mode to local
-  aligner.mode = 'global'
-  
-  # Scoring parameters
-  aligner.match_score = 2.0
-  aligner.mismatch_score = -1.0
+# Append-only journal of the scores and matched pairs (the records with
+# coordinates), one JSON object per line, the first one being the inputs and
+# settings of the run
+JOURNAL_FILE = "coords.journal"
+
+def sequence_digests(index):
+  """[id, length, sha256 of the sequence] of each record of an indexed fasta"""
+  return [[seq_id, index.length(seq_id), hashlib.sha256(index.fetch(seq_id).encode()).hexdigest()]
+    for seq_id in index.ids()]
+
+def journal_settings(args, query_index, target_index):
+  """Inputs (ids, lengths and contents of the sequences) and settings a journal can only be resumed with"""
+  return {
+    'queries': sequence_digests(query_index),
+    'targets': sequence_digests(target_index),
+    'top_k': args.top_k,
+    'kmer_size': args.kmer_size,
+    'window_size': args.window_size,
+    'ambiguity_ratio': args.ambiguity_ratio,
+    'screen_band': args.screen_band,
+    'screen_top': args.screen_top,
+    'align_mode': args.align_mode,
+    'anchor_size': args.anchor_size,
+    'assignment': args.assignment,
+    'engine': args.engine,
+    'scoring': args.scoring
+  }
+
+def read_journal(journal_path, settings):
+  """
+  Return the matched pairs recorded in a journal as {query_id: (target_id,
+  is_rev, score, coordinates)} and the scores as {(query_id, target_id,
+  is_rev): score}, None if there is no journal. A last line cut by the
+  interruption is removed from the file.
+  """
+  if not os.path.exists(journal_path):
+    return None
+  completed = {}
+  scored = {}
+  valid_size = 0
+  with open(journal_path, "rb") as f:
+    for line_number, line in enumerate(f):
+      if not line.endswith(b"\n"):
+        break
+      try:
+        record = json.loads(line)
+      except ValueError:
+        break
+      if line_number == 0:
+        if record != settings:
+          sys.exit(f"Error: {journal_path} was written with other inputs or settings, remove it or run without --resume")
+      elif 'coords' in record:
+        completed[record['query']] = (record['target'], record['is_rev'], record['score'],
+          np.array(record['coords'], dtype=np.int64))
+      else:
+        scored[(record['query'], record['target'], record['is_rev'])] = record['score']
+      valid_size += len(line)
+  if valid_size == 0:
+    return None
+  os.truncate(journal_path, valid_size)
+  return completed, scored
+
+def open_journal(journal_path, settings, append):
+  """Open a journal to append scores and matched pairs, a new one starts with the settings"""
+  if append:
+    return open(journal_path, "a")
+  journal = open(journal_path, "w")
+  journal.write(json.dumps(settings) + "\n")
+  journal.flush()
+  return journal
+
+def write_journal_entry(journal, query_id, target_id, is_rev, score, coordinates):
+  """Record a matched pair, flushed so that it survives the interruption of the run"""
+  journal.write(json.dumps({'query': query_id, 'target': target_id, 'is_rev': bool(is_rev),
+    'score': float(score), 'coords': coordinates.tolist()}) + "\n")
+  journal.flush()
+
+def write_journal_score(journal, query_id, target_id, is_rev, score):
+  """Record a computed score, flushed so that it survives the interruption of the run"""
+  journal.write(json.dumps({'query': query_id, 'target': target_id, 'is_rev': bool(is_rev),
+    'score': float(score)}) + "\n")
+  journal.flush()
+
+# Per-process state for the alignment workers
+_worker = {}
+
+def init_worker(query_index, target_index, align_mode, anchor_size, cache_dir=None, cache_max_size=1024, max_memory=4096,
+  engine="biopython", scoring="coords", screen_band=0):
+  """Setup the alignment backend, the indexed sequences and the cache of an alignment worker"""
+  _worker['backend'] = get_backend(engine, scoring, max_memory * 1024 * 1024)
+  _worker['aligner'] = _worker['backend'].aligner
+  _worker['queries'] = query_index
+  _worker['query_ids'] = query_index.ids()
+  _worker['targets'] = target_index
+  _worker['target_ids'] = target_index.ids()
+  get_query_seq.cache_clear()
+  get_target_seq.cache_clear()
+  _worker['align_mode'] = align_mode
+  _worker['anchor_size'] = anchor_size
+  _worker['cache'] = AlignmentCache(cache_dir, cache_max_size) if cache_dir else None
+  _worker['max_memory'] = max_memory * 1024 * 1024
+  _worker['screen_band'] = screen_band
+
+@lru_cache(maxsize=2)
+def get_query_seq(query_idx, is_rev):
+  """Read a query (reverse complemented if is_rev), the last ones are kept in memory"""
+  query_id = _worker['query_ids'][query_idx]
+  return _worker['queries'].fetch_rc(query_id) if is_rev else _worker['queries'].fetch(query_id)
+
+@lru_cache(maxsize=2)
+def get_target_seq(target_idx):
+  """Read a target, the last ones are kept in memory"""
+  return _worker['targets'].fetch(_worker['target_ids'][target_idx])
+
+def cache_key(query_seq, target_seq):
+  """Key of a pair in the alignment cache"""
+  return _worker['cache'].key(_worker['aligner'], query_seq, target_seq,
+    mode_tag(_worker['align_mode'], _worker['anchor_size']))
+
+def screen_query(task):
+  """
+  Banded scores of a (query index, is_rev, target indices) strand of a query
+  against targets and the metrics of the task
+  """
+  snapshot = metrics.snapshot()
+  query_idx, is_rev, target_idxs = task
+  scores = banded_scores(_worker['aligner'], get_query_seq(query_idx, is_rev),
+    [get_target_seq(target_idx) for target_idx in target_idxs], _worker['screen_band'])
+  return scores, metrics.since(snapshot)
+
+def score_pair(pair):
+  """
+  Score a (query index, target index, is_rev) pair without traceback, return
+  the score, the number of DP cells computed and the metrics of the task
+  """
+  snapshot = metrics.snapshot()
+  query_idx, target_idx, is_rev = pair
+  query_seq = get_query_seq(query_idx, is_rev)
+  target_seq = get_target_seq(target_idx)
+  if _worker['cache'] is not None:
+    key = cache_key(query_seq, target_seq)
+    cached = _worker['cache'].get(key, need_coordinates=False)
+    if cached is not None:
+      return cached[0], 0, metrics.since(snapshot)
+  if _worker['align_mode'] == "anchored":
+    alignment = anchored_align(_worker['aligner'], query_seq, target_seq, _worker['anchor_size'], _worker['max_memory'])
+    score, dp_cells = alignment.score, alignment.dp_cells
+  else:
+    score = _worker['backend'].score(query_seq, target_seq)
+    dp_cells = len(query_seq) * len(target_seq)
+  if _worker['cache'] is not None:
+    _worker['cache'].put(key, score)
+  return score, dp_cells, metrics.since(snapshot)
+
+def align_pair(pair):
+  """
+  Align a (query index, target index, is_rev) pair, return the best alignment
+  score, coordinates (None if no alignment), the number of DP cells computed
+  and the metrics of the task
+  """
+  snapshot = metrics.snapshot()
+  query_idx, target_idx, is_rev = pair
+  query_seq = get_query_seq(query_idx, is_rev)
+  target_seq = get_target_seq(target_idx)
+  if _worker['cache'] is not None:
+    key = cache_key(query_seq, target_seq)
+    cached = _worker['cache'].get(key)
+    if cached is not None:
+      return cached + (0, metrics.since(snapshot))
+  if _worker['align_mode'] == "anchored":
+    alignment = anchored_align(_worker['aligner'], query_seq, target_seq, _worker['anchor_size'], _worker['max_memory'])
+    dp_cells = alignment.dp_cells
+  else:
+    alignment = next(iter(_worker['backend'].align(query_seq, target_seq)), None)
+    dp_cells = len(query_seq) * len(target_seq)
+  if alignment is None:
+    return None, None, dp_cells, metrics.since(snapshot)
+  if _worker['cache'] is not None:
+    _worker['cache'].put(key, alignment.score, alignment.coordinates)
+  return alignment.score, alignment.coordinates, dp_cells, metrics.since(snapshot)
+
+def sketch_sequence(seq, kmer_size, window_size):
+  """Return the set of (hashed) minimizers of a sequence"""
+  return set(minimizer_hashes(seq, kmer_size, window_size).tolist())
+
+def indexed_sketch(index, seq_id, kmer_size, window_size, is_rev=False):
+  """Sketch stored in the reference index of a fasta file, None if not indexed with these sizes"""
+  if not isinstance(index, RefIndex):
+    return None
+  minimizers = index.minimizers(seq_id, kmer_size, window_size, is_rev)
+  return None if minimizers is None else set(minimizers.tolist())
+
+def select_candidates(query_sketches, target_sketches, available_targets, top_k, ambiguity_ratio):
+  """
+  Select the top-k (target index, is_rev) candidates for a query from sketches.
   
-  # Gap parameters
-  aligner.open_gap_score = -10.0
-  aligner.extend_gap_score = -0.5
+  Candidates are ranked by the fraction of query minimizers found in the
+  target. None is returned when the sketch is ambiguous, i.e. nothing is 
+  shared or a candidate beyond the top-k is close to the best one.
+  """
+  ranked = []
+  for is_rev, query_sketch in zip((False, True), query_sketches):
+    if not query_sketch:
+      return None
+    for idx, target in enumerate(available_targets):
+      if target is None:
+        continue
+      shared = len(query_sketch & target_sketches[idx]) / len(query_sketch)
+      ranked.append((shared, idx, is_rev))
+  # Stable sort keeps the exhaustive search order between ties
+  ranked.sort(key=lambda x: x[0], reverse=True)
   
-  # Target only the best alignment
-  aligner.target_end_gap_score = 0.0
-  aligner.query_end_gap_score = 0.0
+  if not ranked or ranked[0][0] == 0:
+    return None
+  if len(ranked) > top_k and ranked[top_k][0] >= ambiguity_ratio * ranked[0][0]:
+    return None
+  return [(idx, is_rev) for _, idx, is_rev in ranked[:top_k]]
+
+def solve_assignment(cost):
+  """
+  Hungarian method: return the column assigned to each row of a square cost
+  matrix (list of lists) minimizing the total cost.
+  """
+  n = len(cost)
+  inf = float('inf')
+  # Potentials of rows (u) and columns (v), p[j] is the row matched to column j (1-based)
+  u = [0.0] * (n + 1)
+  v = [0.0] * (n + 1)
+  p = [0] * (n + 1)
+  way = [0] * (n + 1)
+  for i in range(1, n + 1):
+    p[0] = i
+    j0 = 0
+    minv = [inf] * (n + 1)
+    used = [False] * (n + 1)
+    while True:
+      used[j0] = True
+      i0 = p[j0]
+      delta = inf
+      j1 = 0
+      for j in range(1, n + 1):
+        if not used[j]:
+          cur = cost[i0 - 1][j - 1] - u[i0] - v[j]
+          if cur < minv[j]:
+            minv[j] = cur
+            way[j] = j0
+          if minv[j] < delta:
+            delta = minv[j]
+            j1 = j
+      for j in range(n + 1):
+        if used[j]:
+          u[p[j]] += delta
+          v[j] -= delta
+        else:
+          minv[j] -= delta
+      j0 = j1
+      if p[j0] == 0:
+        break
+    # Augmenting path
+    while True:
+      j1 = way[j0]
+      p[j0] = p[j1]
+      j0 = j1
+      if j0 == 0:
+        break
+  assignment = [0] * n
+  for j in range(1, n + 1):
+    assignment[p[j] - 1] = j - 1
+  return assignment
+
+def assign_optimal(scores):
+  """
+  Return the (target index, is_rev) assigned to each query maximizing the total
+  score, or None if the optimal assignment requires an unscored pair.
   
-  return aligner
+  scores is a Q x T x 2 (forward, reverse) array, NaN for unscored pairs.
+  """
+  n_queries, n_targets, _ = scores.shape
+  # Best strand per pair, forward strand first between ties
+  is_rev = scores[:, :, 1] > np.where(np.isnan(scores[:, :, 0]), -np.inf, scores[:, :, 0])
+  best = np.fmax(scores[:, :, 0], scores[:, :, 1])
+  missing = np.isnan(best)
+  if missing.all():
+    return None
+  # Any assignment with an unscored pair costs more than all others
+  cost = -best
+  finite = cost[~missing]
+  cost[missing] = finite.max() + (finite.max() - finite.min() + 1) * n_queries
+  assignment = solve_assignment(cost.tolist())
+  if any(missing[query_idx, target_idx] for query_idx, target_idx in enumerate(assignment)):
+    return None
+  return [(target_idx, bool(is_rev[query_idx, target_idx])) for query_idx, target_idx in enumerate(assignment)]
 
 def get_alignment_stats(alignment):
   """Get alignment statistics using built-in methods"""
@@ -81,26 +456,6 @@ def get_alignment_stats(alignment):
       'aligned_length': aligned_length
   }
 
-def write_coords(coords_dict, yaml_file):
-    """
-    Writes coordinate mappings to a YAML file using explicit Python tuples as keys.
-    
-    Args:
-        coords_dict: Dictionary mapping sequence ID pairs to coordinate arrays
-        yaml_file: Path to output YAML file
-    """
-    # Convert numpy arrays to lists for JSON serialization
-    output_dict = [
-        {
-          "ids": key,
-          "coords": (arr[0].tolist(), arr[1].tolist())
-        }
-        for key, arr in coords_dict.items()
-    ]
-    
-    with open(yaml_file, 'w') as f:
-      json.dump(output_dict, f)
-
 def write_alignment(alignment, query_id, target_id, stats, fh):
   """Format alignment output similar to BLAST format 0"""
   fh.write(f"Query: {query_id}\n")
@@ -108,24 +463,52 @@ def write_alignment(alignment, query_id, target_id, stats, fh):
   fh.write(f"Score: {stats['score']:.1f}\n")
   fh.write(f"Identity: {stats['identity']:.2f}% ({stats['matches']}/{stats['aligned_length']})\n\n")
   fh.write("## Alignment:\n\n")
-  fh.write(str(alignment))
+  write_alignment_blocks(fh, alignment)
   
 def main():
   args = parse_arguments()
+  if args.profile:
+    metrics.start_profile()
   
   # Create output directory
   os.makedirs(args.out_dir, exist_ok=True)
   
-  # Read sequences
-  queries = list(SeqIO.parse(args.queries, "fasta"))
-  targets = list(SeqIO.parse(args.targets, "fasta"))
+  # Index sequences (read from the fasta files only when needed)
+  with metrics.phase("read_fasta"):
+    query_index = open_sequences(args.queries)
+    target_index = open_sequences(args.targets)
+  query_ids = query_index.ids()
+  target_ids = target_index.ids()
+  metrics.count("queries", len(query_ids))
+  metrics.count("targets", len(target_ids))
   
   # Check if both files have same number of records
-  if len(queries) != len(targets):
-    sys.exit(f"Error: Different number of sequences in input files: {len(queries)} vs {len(targets)}")
+  if len(query_ids) != len(target_ids):
+    sys.exit(f"Error: Different number of sequences in input files: {len(query_ids)} vs {len(target_ids)}")
+  
+  # Matched pairs of an interrupted run, only the other queries and targets
+  # are aligned
+  journal_path = os.path.join(args.out_dir, JOURNAL_FILE)
+  settings = journal_settings(args, query_index, target_index)
+  resumed = read_journal(journal_path, settings) if args.resume else None
+  journal = open_journal(journal_path, settings, resumed is not None)
+  completed, scored = resumed or ({}, {})
+  target_idx_of = {target_id: idx for idx, target_id in enumerate(target_ids)}
+  done_targets = {target_idx_of[target_id] for target_id, _, _, _ in completed.values()}
+  pending_queries = [query_idx for query_idx, query_id in enumerate(query_ids) if query_id not in completed]
+  free_targets = [idx for idx in range(len(target_ids)) if idx not in done_targets]
+  metrics.count("resumed_queries", len(completed))
+  metrics.count("resumed_scores", len(scored))
   
-  # Setup aligner
-  aligner = setup_aligner()
+  # Setup aligner (in the worker processes if any)
+  init_args = (query_index, target_index, args.align_mode, args.anchor_size, args.cache_dir, args.cache_max_size, args.max_memory,
+    args.engine, args.scoring, args.screen_band)
+  # The main process reads its sequences with the worker functions too
+  init_worker(*init_args)
+  map_tasks = map
+  if args.threads > 1:
+    executor = ProcessPoolExecutor(max_workers=args.threads, initializer=init_worker, initargs=init_args)
+    map_tasks = executor.map
   
   # Initialize coordinate mapping dataframe
   coord_maps = {}
@@ -134,75 +517,169 @@ def main():
   queries_basename = Path(args.queries).stem
   targets_basename = Path(args.targets).stem
   
-  # Process each sequence from seqs1
-  available_targets = targets.copy()
+  # Restrict the search to the sketch candidates if not ambiguous
+  all_candidates = [(idx, is_rev) for is_rev in (False, True) for idx in free_targets]
+  candidates = [all_candidates] * len(query_ids)
+  if args.top_k > 0:
+    with metrics.phase("sketch"):
+      available_targets = [None if idx in done_targets else target_id for idx, target_id in enumerate(target_ids)]
+      target_sketches = [None if target_id is None else indexed_sketch(target_index, target_id, args.kmer_size, args.window_size) or
+        sketch_sequence(get_target_seq(idx), args.kmer_size, args.window_size) for idx, target_id in enumerate(available_targets)]
+      for query_idx in pending_queries:
+        query_id = query_ids[query_idx]
+        query_sketches = [indexed_sketch(query_index, query_id, args.kmer_size, args.window_size, is_rev) or
+          sketch_sequence(get_query_seq(query_idx, is_rev), args.kmer_size, args.window_size) for is_rev in (False, True)]
+        query_candidates = select_candidates(query_sketches, target_sketches, available_targets, args.top_k, args.ambiguity_ratio)
+        if query_candidates is None:
+          print(f"Warning: ambiguous sketch for {query_id}, using exhaustive search", file=sys.stderr)
+        else:
+          candidates[query_idx] = query_candidates
+  
+  # Screening: the best (target, strand) by banded score of each query
+  if args.screen_band > 0:
+    with metrics.phase("screen"):
+      tasks = [(query_idx, strand, [idx for idx, is_rev in candidates[query_idx] if is_rev == strand])
+        for query_idx in pending_queries for strand in (False, True)]
+      tasks = [task for task in tasks if task[2]]
+      screen_scores = {}
+      for (query_idx, is_rev, target_idxs), (scores, task) in zip(tasks, map_tasks(screen_query, tasks)):
+        for idx, score in zip(target_idxs, scores):
+          screen_scores[(query_idx, idx, is_rev)] = score
+        if args.threads > 1:
+          metrics.add_task(task)
+      for query_idx in pending_queries:
+        ranked = sorted(candidates[query_idx], key=lambda candidate: -screen_scores[(query_idx, *candidate)])
+        candidates[query_idx] = ranked[:args.screen_top]
+    metrics.count("screened_pairs", len(screen_scores))
+
+  # Phase 1: score matrix (query, target, is_rev), NaN if not computed, each
+  # computed score is journaled
+  scores = np.full((len(query_ids), len(target_ids), 2), np.nan)
+  query_idx_of = {query_id: idx for idx, query_id in enumerate(query_ids)}
+  for (query_id, target_id, is_rev), score in scored.items():
+    scores[query_idx_of[query_id], target_idx_of[target_id], int(is_rev)] = score
+  
+  def fill_scores(pairs):
+    """Compute the scores of (query_idx, target_idx, is_rev) pairs not yet scored"""
+    pairs = [pair for pair in pairs if np.isnan(scores[pair[0], pair[1], int(pair[2])])]
+    with metrics.phase("score"):
+      for pair, (score, dp_cells, task) in zip(pairs, map_tasks(score_pair, pairs)):
+        scores[pair[0], pair[1], int(pair[2])] = score
+        write_journal_score(journal, query_ids[pair[0]], target_ids[pair[1]], pair[2], score)
+        metrics.count("dp_cells_score", dp_cells)
+        if args.threads > 1:
+          metrics.add_task(task)
+    metrics.count("scored_pairs", len(pairs))
+  
+  # Phase 2: assignment of a (target, is_rev) to each query, the queries of
+  # the journal keep their target
+  assignment = [None] * len(query_ids)
+  for query_id, (target_id, is_rev, _, _) in completed.items():
+    assignment[query_idx_of[query_id]] = (target_idx_of[target_id], is_rev)
+  if args.assignment == "optimal":
+    def assign_pending():
+      """Optimal assignment of the free targets to the pending queries"""
+      pending_assignment = assign_optimal(scores[np.ix_(pending_queries, free_targets)])
+      if pending_assignment is None:
+        return None
+      return [(free_targets[idx], is_rev) for idx, is_rev in pending_assignment]
+    
+    fill_scores([(query_idx, idx, is_rev) for query_idx in pending_queries for idx, is_rev in candidates[query_idx]])
+    pending_assignment = assign_pending() if pending_queries else []
+    if pending_assignment is None:
+      # Candidates do not allow a 1-to-1 assignment, score all pairs
+      fill_scores([(query_idx, idx, is_rev) for query_idx in pending_queries for idx, is_rev in all_candidates])
+      pending_assignment = assign_pending()
+    for query_idx, match in zip(pending_queries, pending_assignment or []):
+      assignment[query_idx] = match
+  else:
+    available = [idx not in done_targets for idx in range(len(target_ids))]
+    for query_idx in pending_queries:
+      options = [(idx, is_rev) for idx, is_rev in candidates[query_idx] if available[idx]]
+      if not options:
+        options = [(idx, is_rev) for idx, is_rev in all_candidates if available[idx]]
+      fill_scores([(query_idx, idx, is_rev) for idx, is_rev in options])
+      # First best option in candidates order
+      best_score = float('-inf')
+      best = None
+      for idx, is_rev in options:
+        if scores[query_idx, idx, int(is_rev)] > best_score:
+          best_score = scores[query_idx, idx, int(is_rev)]
+          best = (idx, is_rev)
+      assignment[query_idx] = best
+      if best is not None:
+        available[best[0]] = False
+  
+  # Traceback only for the matched pairs, each one being journaled
+  matched_pairs = [(query_idx, *assignment[query_idx]) for query_idx in pending_queries if assignment[query_idx] is not None]
+  alignments = {(query_idx_of[query_id], target_idx_of[target_id], is_rev): (score, coordinates)
+    for query_id, (target_id, is_rev, score, coordinates) in completed.items()}
+  with metrics.phase("traceback"):
+    for pair, (score, coordinates, dp_cells, task) in zip(matched_pairs, map_tasks(align_pair, matched_pairs)):
+      metrics.count("dp_cells_traceback", dp_cells)
+      if args.threads > 1:
+        metrics.add_task(task)
+      alignments[pair] = None if coordinates is None else (score, coordinates)
+      if coordinates is not None:
+        write_journal_entry(journal, query_ids[pair[0]], target_ids[pair[1]], pair[2], score, coordinates)
+    if args.threads > 1:
+      executor.shutdown()
+  journal.close()
+  metrics.count("aligned_pairs", len(matched_pairs))
+  
   os.makedirs(args.out_dir, exist_ok=True)
 
   reoriented_queries_file = open(f"{args.out_dir}/{queries_basename}.reoriented.fasta", "w")
   
-  for query in queries:
-    best_score = float('-inf')
-    best_alignment = None
-    best_target = None
-    best_target_idx = None
-    best_stats = None
+  for query_idx, query_id in enumerate(query_ids):
+    if assignment[query_idx] is None or alignments[(query_idx, *assignment[query_idx])] is None:
+      sys.exit(f"Error: No alignment found for sequence {query_id}")
+    best_target_idx, best_is_rev = assignment[query_idx]
+    best_target_id = target_ids[best_target_idx]
+    best_score, best_coordinates = alignments[(query_idx, best_target_idx, best_is_rev)]
     
-    # Find best matching sequence in seqs2
-    for query_seq, is_rev in [ (query.seq, False), (query.seq.reverse_complement(), True) ]:
-      for idx, target in enumerate(available_targets):
-        if target is None:
-          continue
-          
-        # Perform alignment
-        alignments = aligner.align(query_seq, target.seq)
-        if alignments:
-          # Get the best scoring alignment
-          alignment = alignments[0]
-          stats = get_alignment_stats(alignment)
-          
-          if alignment.score > best_score:
-            best_score = alignment.score
-            best_alignment = alignment
-            best_target = target
-            best_target_idx = idx
-            best_stats = stats
-            best_is_rev = is_rev
-    
-    if best_alignment is None:
-      sys.exit(f"Error: No alignment found for sequence {query.id}")
+    # Rebuild the best alignment from its coordinates
+    query_seq = Seq(get_query_seq(query_idx, best_is_rev))
+    best_alignment = Alignment([query_seq, Seq(get_target_seq(best_target_idx))], best_coordinates)
+    best_alignment.score = best_score
+    with metrics.phase("stats"):
+      best_stats = get_alignment_stats(best_alignment)
     
     if best_is_rev:
-      query.seq = query.seq.reverse_complement()
-      query.id = query_seq.id + "_rev"
-      SeqIO.write(query, reoriented_queries_file, "fasta")
+      query_id = query_id + "_rev"
+      query = SeqRecord(query_seq, id=query_id, description=query_index.description(query_ids[query_idx]))
+      with metrics.phase("write_fasta"):
+        SeqIO.write(query, reoriented_queries_file, "fasta")
     
     # Check thresholds
     if (best_stats['identity'] < args.min_identity):
-      sys.exit(f"Error: Identity below threshold for {query.id}\n" +
+      sys.exit(f"Error: Identity below threshold for {query_id}\n" +
         f"Identity: {best_stats['identity']:.2f}%")
     
     # Write alignment to file
-    aln_filename = f"{targets_basename}_{query.id}_{targets_basename}_{best_target.id}.aln"
+    aln_filename = f"{targets_basename}_{query_id}_{targets_basename}_{best_target_id}.aln"
     aln_path = os.path.join(args.out_dir, aln_filename)
     
-    with open(aln_path, 'w') as f:
+    with metrics.phase("write_report"), open(aln_path, 'w') as f:
       write_alignment(
         best_alignment,
-        query.id,
-        best_target.id,
+        query_id,
+        best_target_id,
         best_stats,
         f
       )
     
     # Create coordinate mapping
-    coord_maps[(query.id, best_target.id)] = best_alignment.coordinates
-    
-    # Remove used target from available sequences
-    available_targets[best_target_idx] = None
+    coord_maps[(query_id, best_target_id)] = best_alignment.coordinates
   reoriented_queries_file.close()
     
   # Create and save coordinate mapping DataFrame
-  write_coords(coord_maps, f"{args.out_dir}/coords.json")
+  with metrics.phase("write_coords"):
+    if args.coords_format in ("bin", "both"):
+      write_coords_bin(coord_maps, f"{args.out_dir}/coords.bin")
+    if args.coords_format in ("json", "both"):
+      write_coords_json(coord_maps, f"{args.out_dir}/coords.json")
+  metrics.write(args.metrics_json, args.profile)
 
 if __name__ == "__main__":
   main()
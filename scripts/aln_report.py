@@ -0,0 +1,145 @@
+#!/usr/bin/env python3
+
+"""
+Streaming writer for pairwise alignment reports.
+
+The aligned sequences are generated window by window from the alignment
+coordinates, so the whole alignment text is never held in memory and the
+report is linear in the genome length. Enumeration of co-optimal alignments
+is bounded by max_alignments.
+
+Two layouts are written:
+  - write_alignment_blocks: the block layout of str(alignment) (Biopython
+    pretty format, 60 columns per line, labelled target / query lines), used
+    for the align_coords.py .aln files
+  - write_alignment_windows: windows of 50 columns with 0-based coordinates,
+    used for the transfer_annot.py --verbose report
+"""
+
+from itertools import islice
+
+def iter_windows(alignment, window_size=50):
+  """Yield the (target, query) aligned strings of successive windows of an alignment"""
+  target, query = alignment.sequences[0], alignment.sequences[1]
+  coordinates = alignment.coordinates
+  target_parts = []
+  query_parts = []
+  n_columns = 0
+  for k in range(coordinates.shape[1] - 1):
+    target_start, target_end = int(coordinates[0, k]), int(coordinates[0, k + 1])
+    query_start, query_end = int(coordinates[1, k]), int(coordinates[1, k + 1])
+    step_size = max(target_end - target_start, query_end - query_start)
+    offset = 0
+    while offset < step_size:
+      size = min(step_size - offset, window_size - n_columns)
+      if target_end > target_start:
+        target_parts.append(str(target[target_start + offset:target_start + offset + size]))
+      else:
+        target_parts.append("-" * size)
+      if query_end > query_start:
+        query_parts.append(str(query[query_start + offset:query_start + offset + size]))
+      else:
+        query_parts.append("-" * size)
+      offset += size
+      n_columns += size
+      if n_columns == window_size:
+        yield "".join(target_parts), "".join(query_parts)
+        target_parts = []
+        query_parts = []
+        n_columns = 0
+  if n_columns > 0:
+    yield "".join(target_parts), "".join(query_parts)
+
+def match_line(target, query):
+  """Return the match line of aligned strings: | identity, . mismatch, space for a gap"""
+  return "".join(
+    " " if t == "-" or q == "-" else "|" if t == q else "."
+    for t, q in zip(target, query)
+  )
+
+def format_block_pos(pos):
+  """Start position field of a block line (right aligned in 9 characters, as Biopython)"""
+  text = str(pos)
+  if len(text) > 9:
+    return " .." + text[len(text) - 6:] + " "
+  return text.rjust(9) + " "
+
+def write_alignment_blocks(fh, alignment, names=("target", "query"), line_columns=60):
+  """
+  Write a pairwise alignment (sequences in forward orientation) as
+  str(alignment) does, line_columns columns per block
+  """
+  ends = [int(alignment.coordinates[0, -1]), int(alignment.coordinates[1, -1])]
+  labels = [name[:9].ljust(10) for name in names]
+  # Position of the first letter of the lines and column of the first
+  # pattern character of the block
+  target_pos, query_pos = int(alignment.coordinates[0, 0]), int(alignment.coordinates[1, 0])
+  column = 0
+  block = None
+  for target, query in iter_windows(alignment, line_columns):
+    if block is not None:
+      fh.write("\n".join(block) + "\n\n")
+    pattern = "".join(
+      "|" if t == q else "-" if t == "-" or q == "-" else "."
+      for t, q in zip(target, query)
+    )
+    block = [
+      labels[0] + format_block_pos(target_pos) + target,
+      "          %9d %s" % (column, pattern),
+      labels[1] + format_block_pos(query_pos) + query
+    ]
+    target_pos += len(target) - target.count("-")
+    query_pos += len(query) - query.count("-")
+    column += len(target)
+  if block is None:
+    return
+  if len(block[0]) - 20 == line_columns:
+    # a full last line is followed by an empty block (as Biopython does)
+    fh.write("\n".join(block) + "\n\n")
+    block = [labels[0] + format_block_pos(target_pos), "          %9d " % column, labels[1] + format_block_pos(query_pos)]
+  # End positions on the last block if they fit in the line, on a block of
+  # their own otherwise
+  end_width = len(str(max(ends[0], ends[1], column)))
+  if len(block[0]) + end_width <= 80:
+    if len(block[0]) > 20:
+      block[0] += " %*d" % (end_width, ends[0])
+      block[1] += " %*d" % (end_width, column)
+      block[2] += " %*d" % (end_width, ends[1])
+    fh.write("\n".join(block) + "\n")
+  else:
+    fh.write("\n".join(block) + "\n\n")
+    fh.write(f"{labels[0]}{ends[0]:9d}\n          {column:9d}\n{labels[1]}{ends[1]:9d}\n")
+
+def format_pos(pos):
+  return str(pos) + " " * (10 - len(str(pos)))
+
+def write_alignment_windows(fh, alignment, window_size=50):
+  """Write an alignment by windows of window_size columns with 0-based coordinates"""
+  column = 0
+  # Last target/query position before the window
+  target_pos = query_pos = -1
+  for target, query in iter_windows(alignment, window_size):
+    target_start = target_pos + (target[0] != "-")
+    query_start = query_pos + (query[0] != "-")
+    target_pos += len(target) - target.count("-")
+    query_pos += len(query) - query.count("-")
+    fh.write("\n")
+    fh.write("print alignment with 0-based coord\n")
+    fh.write("\n")
+    fh.write(format_pos(target_start) + target + " " + str(target_pos) + "\n")
+    fh.write(format_pos(column) + match_line(target, query) + " " + str(column + len(target) - 1) + "\n")
+    fh.write(format_pos(query_start) + query + " " + str(query_pos) + "\n")
+    column += len(target)
+
+def write_alignment_summary(fh, alignments, max_alignments):
+  """Write a summary table of (at most max_alignments) alignments"""
+  fh.write("Alignment Length | Aligned Bases from Target | Aligned Bases from Query | Alignment Score\n")
+  fh.write("-" * 80 + "\n")
+  for alignment in islice(alignments, max_alignments):
+    coordinates = alignment.coordinates
+    steps = abs(coordinates[:, 1:] - coordinates[:, :-1])
+    alignment_length = int(steps.max(axis=0).sum())
+    target_aligned_bases = int(steps[0].sum())
+    query_aligned_bases = int(steps[1].sum())
+    alignment_score = alignment.score
+    fh.write(f"{alignment_length:^18} | {target_aligned_bases:^25} | {query_aligned_bases:^27} | {alignment_score:^18}\n")
@@ -0,0 +1,185 @@
+#!/usr/bin/env python3
+
+"""
+Anchor-chained global alignment for long and similar sequences.
+
+Exact k-mers unique in both sequences (uppercase ACGT only, the aligners are
+case sensitive) are used as anchors. Anchors are chained colinearly (longest
+increasing chain), merged into exact match blocks and the dynamic programming
+is only run on the segments between blocks. The
+result is a Bio.Align.Alignment with a `coordinates` array of the same form as
+an exhaustive global alignment with the same aligner (gaps may be placed
+differently among co-optimal alignments).
+
+Only the match/mismatch scoring is supported (no substitution matrix).
+"""
+
+import copy
+from bisect import bisect_left
+import numpy as np
+from Bio.Align import Alignment
+from linear_align import global_align, simplify_coordinates
+
+ALIGN_MODES = ["exhaustive", "anchored"]
+
+# The aligners are case sensitive: lowercase (soft-masked) letters are not
+# anchored, only identical letters are merged into exact match blocks
+NT_CODES = np.full(256, 4, dtype=np.uint8)
+NT_CODES_NOCASE = np.full(256, 4, dtype=np.uint8)
+for _i, _nt in enumerate(b"ACGT"):
+  NT_CODES[_nt] = _i
+  NT_CODES_NOCASE[_nt] = _i
+  NT_CODES_NOCASE[ord(chr(_nt).lower())] = _i
+
+def encode_kmers(seq, kmer_size, ignore_case=False):
+  """
+  Return the 2-bit encoded k-mers of a sequence (k <= 32) as uint64 and a mask
+  of k-mers containing an ambiguous base (or a lowercase one, unless
+  ignore_case).
+  """
+  codes = (NT_CODES_NOCASE if ignore_case else NT_CODES)[np.frombuffer(str(seq).encode(), dtype=np.uint8)]
+  n_kmers = max(len(codes) - kmer_size + 1, 0)
+  kmers = np.zeros(n_kmers, dtype=np.uint64)
+  invalid = np.zeros(n_kmers, dtype=bool)
+  for j in range(kmer_size if n_kmers else 0):
+    window = codes[j:j + n_kmers]
+    kmers = (kmers << np.uint64(2)) | (window & 3).astype(np.uint64)
+    invalid |= window > 3
+  return kmers, invalid
+
+def _unique_kmers(seq, kmer_size):
+  """Return the k-mers occurring once in a sequence (sorted) and their positions"""
+  kmers, invalid = encode_kmers(seq, kmer_size)
+  positions = np.flatnonzero(~invalid)
+  values, first, counts = np.unique(kmers[positions], return_index=True, return_counts=True)
+  return values[counts == 1], positions[first[counts == 1]]
+
+def find_anchors(target, query, kmer_size):
+  """Return (target_pos, query_pos) of k-mers unique in both sequences, sorted by target_pos"""
+  target_kmers, target_pos = _unique_kmers(target, kmer_size)
+  query_kmers, query_pos = _unique_kmers(query, kmer_size)
+  _, target_idx, query_idx = np.intersect1d(target_kmers, query_kmers, assume_unique=True, return_indices=True)
+  anchors = np.stack([target_pos[target_idx], query_pos[query_idx]], axis=1)
+  return anchors[np.argsort(anchors[:, 0], kind="stable")]
+
+def chain_anchors(anchors, kmer_size):
+  """
+  Chain anchors colinearly and merge them into non overlapping exact match
+  blocks (target_start, query_start, length).
+  """
+  # Longest strictly increasing chain of query positions (target sorted)
+  tails = []
+  tails_idx = []
+  previous = [-1] * len(anchors)
+  for idx, query_pos in enumerate(anchors[:, 1].tolist()):
+    rank = bisect_left(tails, query_pos)
+    if rank > 0:
+      previous[idx] = tails_idx[rank - 1]
+    if rank == len(tails):
+      tails.append(query_pos)
+      tails_idx.append(idx)
+    else:
+      tails[rank] = query_pos
+      tails_idx[rank] = idx
+  chain = []
+  idx = tails_idx[-1] if tails_idx else -1
+  while idx >= 0:
+    chain.append(anchors[idx].tolist())
+    idx = previous[idx]
+  chain.reverse()
+
+  # Merge overlapping anchors of the same diagonal, trim overlaps between diagonals
+  blocks = []
+  for target_pos, query_pos in chain:
+    end = target_pos + kmer_size
+    if blocks:
+      last_target, last_query, last_len = blocks[-1]
+      if target_pos - query_pos == last_target - last_query and target_pos <= last_target + last_len:
+        blocks[-1][2] = end - last_target
+        continue
+      overlap = max(last_target + last_len - target_pos, last_query + last_len - query_pos, 0)
+      target_pos += overlap
+      query_pos += overlap
+    if end - target_pos > 0:
+      blocks.append([target_pos, query_pos, end - target_pos])
+  return blocks
+
+def _segment_aligner(aligner, left_end, right_end):
+  """Copy an aligner where the gaps on a side not at a sequence end are scored as internal gaps"""
+  segment_aligner = copy.deepcopy(aligner)
+  for seq in ("target", "query"):
+    for side, is_end in (("left", left_end), ("right", right_end)):
+      if not is_end:
+        for step in ("open", "extend"):
+          setattr(segment_aligner, f"{seq}_{side}_{step}_gap_score",
+            getattr(aligner, f"{seq}_internal_{step}_gap_score"))
+  return segment_aligner
+
+def _gap_score(aligner, seq, side, length):
+  """Score of a gap of given length in seq ("target" or "query") at side ("left", "internal", "right")"""
+  if length == 0:
+    return 0.0
+  return getattr(aligner, f"{seq}_{side}_open_gap_score") + \
+    (length - 1) * getattr(aligner, f"{seq}_{side}_extend_gap_score")
+
+def _align_segment(aligner, segment_aligners, target, query, left_end, right_end, max_memory=None):
+  """Globally align a segment, return its score and coordinates (relative to the segment)"""
+  if len(target) == 0 or len(query) == 0:
+    if len(target) == 0 and len(query) == 0:
+      return 0.0, np.zeros((2, 1), dtype=np.int64)
+    gap_seq = "target" if len(target) == 0 else "query"
+    side = "left" if left_end else "right" if right_end else "internal"
+    score = _gap_score(aligner, gap_seq, side, max(len(target), len(query)))
+    return score, np.array([[0, len(target)], [0, len(query)]])
+  if (left_end, right_end) not in segment_aligners:
+    segment_aligners[(left_end, right_end)] = _segment_aligner(aligner, left_end, right_end)
+  alignment = global_align(segment_aligners[(left_end, right_end)], target, query, max_memory)
+  return alignment.score, alignment.coordinates
+
+def anchored_align(aligner, target, query, kmer_size, max_memory=None):
+  """
+  Global alignment of target and query restricted to the segments between
+  chained exact k-mer anchors. Falls back to the exhaustive alignment if no
+  anchor is found. The alignments whose traceback would exceed max_memory
+  (bytes) are computed in linear memory (see linear_align).
+
+  Returns a Bio.Align.Alignment with its score and the number of dynamic
+  programming cells computed (dp_cells).
+  """
+  blocks = chain_anchors(find_anchors(target, query, kmer_size), kmer_size)
+  if not blocks:
+    alignment = global_align(aligner, target, query, max_memory)
+    alignment.dp_cells = len(target) * len(query)
+    return alignment
+
+  score = 0.0
+  dp_cells = 0
+  segment_aligners = {}
+  points = [np.zeros((2, 1), dtype=np.int64)]
+  target_end = query_end = 0
+  for idx, (target_pos, query_pos, length) in enumerate(blocks + [[len(target), len(query), 0]]):
+    # Segment between the previous block and this one
+    segment_score, segment_coords = _align_segment(
+      aligner,
+      segment_aligners,
+      target[target_end:target_pos],
+      query[query_end:query_pos],
+      left_end=(idx == 0),
+      right_end=(idx == len(blocks)),
+      max_memory=max_memory
+    )
+    score += segment_score
+    dp_cells += (target_pos - target_end) * (query_pos - query_end)
+    points.append(segment_coords[:, 1:] + np.array([[target_end], [query_end]]))
+    # Exact match block
+    if length > 0:
+      score += length * aligner.match_score
+      points.append(np.array([[target_pos + length], [query_pos + length]]))
+    target_end = target_pos + length
+    query_end = query_pos + length
+
+  coordinates = simplify_coordinates(np.concatenate(points, axis=1))
+  alignment = Alignment([target, query], coordinates)
+  alignment.score = score
+  alignment.dp_cells = dp_cells
+  return alignment
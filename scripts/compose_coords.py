@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+
+import sys
+import argparse
+import numpy as np
+from coords_io import (REV_SUFFIX, read_coords, write_coords_bin, write_coords_json, write_chain,
+  coordinates_to_blocks, blocks_to_coordinates)
+
+DOCS = """
+Compose coordinate mappings across serial passages.
+
+Each mapping file is the output of align_coords.py (coords.bin, coords.json)
+or a UCSC chain file, the queries of a mapping being the targets of the next
+one:
+  ref -> P0: align_coords.py --queries P0.fa --targets ref.fa
+  P0 -> P1:  align_coords.py --queries P1.fa --targets P0.fa
+  ...
+The composed mapping ref -> Pn (queries of the last mapping vs targets of the
+first one) is computed from the aligned blocks in linear time, so a new
+passage only needs one (cheap) alignment against the previous passage. With
+a single mapping file, the mapping is converted to the output format.
+
+A query reoriented by align_coords.py (<id>_rev) is followed on the reverse
+strand of <id> in the next mapping.
+
+The output can be given to transfer_annot.py -coords (any format).
+"""
+
+def parse_arguments():
+  parser = argparse.ArgumentParser(description=DOCS, formatter_class=argparse.RawTextHelpFormatter)
+  parser.add_argument('--maps', nargs='+', required=True,
+    help='Mapping files (coords.bin, coords.json or chain) from the reference\n' +
+    'to the last passage')
+  parser.add_argument('--out', required=True, help='Output mapping file')
+  parser.add_argument('--format', choices=['bin', 'json', 'chain'], default=None,
+    help='Output format (default: from the output extension, .json, .chain\n' +
+    'or bin otherwise)')
+  return parser.parse_args()
+
+def compose_blocks(blocks_ab, blocks_bc):
+  """
+  Compose sorted aligned blocks (a, b, size) of a -> b with (b, c, size) of
+  b -> c into the blocks (a, c, size) of a -> c, in O(number of blocks).
+  """
+  composed = []
+  i = j = 0
+  while i < len(blocks_ab) and j < len(blocks_bc):
+    a, b1, size1 = blocks_ab[i]
+    b2, c, size2 = blocks_bc[j]
+    start = max(b1, b2)
+    end = min(b1 + size1, b2 + size2)
+    if start < end:
+      composed.append((a + start - b1, c + start - b2, end - start))
+    if b1 + size1 <= b2 + size2:
+      i += 1
+    else:
+      j += 1
+  return composed
+
+def reverse_blocks(blocks, size0, size1):
+  """Blocks of the same alignment between the reverse complements of both sequences"""
+  blocks = np.asarray(blocks, dtype=np.int64).reshape(-1, 3)[::-1]
+  return np.stack([size0 - blocks[:, 0] - blocks[:, 2], size1 - blocks[:, 1] - blocks[:, 2], blocks[:, 2]], axis=1)
+
+def toggle_rev(seq_id):
+  return seq_id[:-len(REV_SUFFIX)] if seq_id.endswith(REV_SUFFIX) else seq_id + REV_SUFFIX
+
+def compose_coordinates(coords_1, coords_2, reverse=False):
+  """
+  Compose the coordinates of q1 vs t1 (row 0 q1, row 1 t1) with the ones of
+  q2 vs q1 (row 0 q2, row 1 q1) into the coordinates of q2 vs t1. If reverse,
+  q1 in coords_1 is the reverse complement of q1 in coords_2.
+  """
+  q1_size, t1_size = int(coords_1[0][-1]), int(coords_1[1][-1])
+  q2_size = int(coords_2[0][-1])
+  if int(coords_2[1][-1]) != q1_size:
+    raise ValueError(f"Inconsistent sequence sizes between mappings: {q1_size} vs {int(coords_2[1][-1])}")
+  # (t1, q1) and (q1, q2) blocks
+  blocks_1 = coordinates_to_blocks(coords_1)[:, [1, 0, 2]]
+  blocks_2 = coordinates_to_blocks(coords_2)[:, [1, 0, 2]]
+  if reverse:
+    blocks_2 = reverse_blocks(blocks_2, q1_size, q2_size)
+  blocks = np.asarray(compose_blocks(blocks_1.tolist(), blocks_2.tolist()), dtype=np.int64).reshape(-1, 3)
+  return blocks_to_coordinates(blocks[:, [1, 0, 2]], q2_size, t1_size)
+
+def compose_maps(maps_1, maps_2):
+  """
+  Compose two mappings {(query_id, target_id): coordinates}, the targets of
+  maps_2 being the queries of maps_1.
+  """
+  by_target = {}
+  for (query_id, target_id), coordinates in maps_2.items():
+    by_target.setdefault(target_id, (query_id, coordinates))
+  composed = {}
+  for (query_id, target_id), coordinates in maps_1.items():
+    reverse = query_id.endswith(REV_SUFFIX) and query_id not in by_target
+    name = toggle_rev(query_id) if reverse else query_id
+    if name not in by_target:
+      print(f"Warning: no mapping of {name} in the next passage, {target_id} is dropped", file=sys.stderr)
+      continue
+    next_query_id, next_coordinates = by_target[name]
+    if reverse:
+      next_query_id = toggle_rev(next_query_id)
+    composed[(next_query_id, target_id)] = compose_coordinates(coordinates, next_coordinates, reverse)
+  return composed
+
+def main():
+  args = parse_arguments()
+  maps = read_coords(args.maps[0])
+  for maps_file in args.maps[1:]:
+    maps = compose_maps(maps, read_coords(maps_file))
+
+  out_format = args.format
+  if out_format is None:
+    out_format = "json" if args.out.endswith(".json") else "chain" if args.out.endswith(".chain") else "bin"
+  if out_format == "bin":
+    write_coords_bin(maps, args.out)
+  elif out_format == "json":
+    write_coords_json(maps, args.out)
+  else:
+    write_chain(maps, args.out)
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,315 @@
+#!/usr/bin/env python3
+
+"""
+Compact binary format for alignment coordinates.
+
+Layout of a coords.bin file:
+  - magic b"VVCOORD1"
+  - uint64 (little endian) size of the JSON header
+  - JSON header: {"pairs": [{"ids": [query_id, target_id], "offset": o, "n": n}]}
+  - padding to a multiple of 8 bytes
+  - one int32 block per pair of shape (2, n) (C order) at byte offset o from
+    the start of the file: row 0 the query coordinates, row 1 the target ones
+
+The file is memory-mapped, so a single pair can be read (and positions mapped)
+without loading the other ones.
+
+Mappings can also be read from and written to coords.json files and UCSC
+chain files. In a chain file the reference (target of align_coords.py) is
+the chain target and the assembly (query) is the chain query: a query
+reoriented by align_coords.py (<id>_rev) is written on the "-" strand of
+<id>, and a "-" strand chain is read as a <qName>_rev query.
+"""
+
+import sys
+import json
+from bisect import bisect_right
+import numpy as np
+
+MAGIC = b"VVCOORD1"
+REV_SUFFIX = "_rev"
+
+def write_coords_bin(coords_dict, bin_file):
+  """
+  Writes coordinate mappings to a binary file.
+
+  Args:
+      coords_dict: Dictionary mapping sequence ID pairs to coordinate arrays
+      bin_file: Path to output binary file
+  """
+  blocks = [np.ascontiguousarray(arr, dtype="<i4") for arr in coords_dict.values()]
+  # The header size depends on the offsets: compute them from the header size
+  # without offsets, with enough room for offset digits
+  pairs = [{"ids": list(key), "offset": 0, "n": int(block.shape[1])} for key, block in zip(coords_dict, blocks)]
+  header_size = len(json.dumps({"pairs": pairs}).encode()) + 20 * len(pairs)
+  offset = -(-(len(MAGIC) + 8 + header_size) // 8) * 8
+  for pair, block in zip(pairs, blocks):
+    pair["offset"] = offset
+    offset += -(-block.nbytes // 8) * 8
+  header = json.dumps({"pairs": pairs}).encode().ljust(header_size)
+
+  with open(bin_file, "wb") as f:
+    f.write(MAGIC)
+    f.write(np.uint64(len(header)).astype("<u8").tobytes())
+    f.write(header)
+    for pair, block in zip(pairs, blocks):
+      f.write(b"\0" * (pair["offset"] - f.tell()))
+      f.write(block.tobytes())
+
+class CoordsFile:
+  """Random access to the coordinates of a binary coords file"""
+
+  def __init__(self, bin_file):
+    self.data = np.memmap(bin_file, dtype=np.uint8, mode="r")
+    if self.data[:len(MAGIC)].tobytes() != MAGIC:
+      raise ValueError(f"{bin_file} is not a binary coords file")
+    header_size = int(self.data[len(MAGIC):len(MAGIC) + 8].view("<u8")[0])
+    header_start = len(MAGIC) + 8
+    header = json.loads(self.data[header_start:header_start + header_size].tobytes())
+    self.pairs = {tuple(pair["ids"]): (pair["offset"], pair["n"]) for pair in header["pairs"]}
+
+  def ids(self):
+    """Return the list of (query_id, target_id) pairs"""
+    return list(self.pairs)
+
+  def coordinates(self, query_id, target_id):
+    """Return the (2, n) int32 coordinates of a pair (memory-mapped, not copied)"""
+    offset, n = self.pairs[(query_id, target_id)]
+    return self.data[offset:offset + 8 * n].view("<i4").reshape(2, n)
+
+  def map_positions(self, query_id, target_id, positions, reverse=False):
+    """Map 0-based positions of the query to the target (or target to query if reverse)"""
+    return map_positions(self.coordinates(query_id, target_id), positions, reverse)
+
+  def map_position(self, query_id, target_id, position, reverse=False):
+    """Map a single 0-based position, see map_positions"""
+    return int(self.map_positions(query_id, target_id, [position], reverse)[0])
+
+def map_positions(coordinates, positions, reverse=False):
+  """
+  Map 0-based positions of the first sequence of an alignment coordinates
+  array to the second one (or second to first if reverse) in O(log blocks)
+  per position.
+
+  Positions in a gap of the other sequence are mapped to the previous aligned
+  base of the other sequence (-1 if none), and the sequence length to the
+  other sequence length.
+  """
+  src, dst = (coordinates[1], coordinates[0]) if reverse else (coordinates[0], coordinates[1])
+  positions = np.asarray(positions, dtype=np.int64)
+  if np.any((positions < 0) | (positions > src[-1])):
+    raise ValueError(f"Position out of range [0, {src[-1]}]")
+  # Last point at or before each position, its next step covers the position
+  step = np.searchsorted(src, positions, side="right") - 1
+  step = np.minimum(step, len(src) - 2)
+  offset = positions - src[step]
+  is_aligned = dst[step + 1] > dst[step]
+  mapped = np.where(is_aligned, dst[step] + offset, dst[step] - 1)
+  return np.where(positions == src[-1], dst[-1], mapped)
+
+class CoordMap:
+  """
+  Compact map of all the 0-based positions of a sequence (and its length) to
+  another sequence (as map_positions), stored by blocks of positions:
+  int32 arrays of the first position of each block, its mapped position and
+  whether the block is aligned (mapped positions increase with the position)
+  or in a gap of the other sequence (all mapped to the same position).
+
+  Indexing (a position or an array of positions) returns the same values as
+  indexing the dense list of all the mapped positions, negative positions are
+  counted from the end.
+  Lookups are O(log blocks), the lookups of single positions use list copies
+  of the arrays (made on the first one) to avoid numpy scalar operations.
+  """
+
+  def __init__(self, starts, values, aligned, size):
+    self.starts = np.asarray(starts, dtype=np.int32)
+    self.values = np.asarray(values, dtype=np.int32)
+    self.aligned = np.asarray(aligned, dtype=np.int32)
+    self.size = int(size)
+    self._blocks = None
+
+  @classmethod
+  def from_coordinates(cls, coordinates, reverse=False, base1=False):
+    """
+    Map of the first sequence of an alignment coordinates array to the second
+    one (or second to first if reverse). With base1, positions and mapped
+    positions are 1-based and 0 is mapped to 0.
+    """
+    src, dst = (coordinates[1], coordinates[0]) if reverse else (coordinates[0], coordinates[1])
+    src = np.asarray(src, dtype=np.int64)
+    dst = np.asarray(dst, dtype=np.int64)
+    # Steps without position of the first sequence (gaps) are not blocks
+    keep = np.diff(src) > 0
+    aligned = (np.diff(dst) > 0)[keep]
+    starts = np.append(src[:-1][keep], src[-1])
+    values = np.append(np.where(aligned, dst[:-1][keep], dst[:-1][keep] - 1), dst[-1])
+    aligned = np.append(aligned, False)
+    size = src[-1] + 1
+    if base1:
+      starts = np.concatenate([[0], starts + 1])
+      values = np.concatenate([[0], values + 1])
+      aligned = np.concatenate([[False], aligned])
+      size += 1
+    return cls(starts, values, aligned, size)
+
+  def __len__(self):
+    return self.size
+
+  def __getitem__(self, position):
+    if not isinstance(position, int) and np.ndim(position) > 0:
+      return self.lookup(position)
+    if not -self.size <= position < self.size:
+      raise IndexError("list index out of range")
+    if position < 0:
+      position += self.size
+    if self._blocks is None:
+      self._blocks = (self.starts.tolist(), self.values.tolist(), self.aligned.tolist())
+    starts, values, aligned = self._blocks
+    block = bisect_right(starts, position) - 1
+    return values[block] + aligned[block] * (position - starts[block])
+
+  def lookup(self, positions):
+    """Mapped positions of an array of positions (vectorized)"""
+    positions = np.asarray(positions, dtype=np.int64)
+    if np.any((positions < -self.size) | (positions >= self.size)):
+      raise IndexError(f"index out of bounds for size {self.size}")
+    positions = np.where(positions < 0, positions + self.size, positions)
+    block = np.searchsorted(self.starts, positions, side="right") - 1
+    return self.values[block] + self.aligned[block].astype(np.int64) * (positions - self.starts[block])
+
+  def transform(self, position):
+    """
+    Mapped position clamped to 0 (positions before the first aligned base of
+    the other sequence), ValueError if the position is after the length.
+    """
+    if position >= self.size:
+      raise ValueError(f"Index ({position}) >= List size {self.size}")
+    return max(self[position], 0)
+
+  def transform_array(self, positions):
+    """transform of an array of positions (vectorized)"""
+    positions = np.asarray(positions)
+    too_large = positions >= self.size
+    if too_large.any():
+      raise ValueError(f"Index ({positions[too_large][0]}) >= List size {self.size}")
+    return np.maximum(self.lookup(positions), 0)
+
+  def nbytes(self):
+    return self.starts.nbytes + self.values.nbytes + self.aligned.nbytes
+
+def write_coords_json(coords_dict, json_file):
+  """Write coordinate mappings to a coords.json file (as align_coords.py)"""
+  output = [
+    {"ids": list(key), "coords": (arr[0].tolist(), arr[1].tolist())}
+    for key, arr in coords_dict.items()
+  ]
+  with open(json_file, "w") as f:
+    json.dump(output, f)
+
+def coordinates_to_blocks(coordinates):
+  """Return the aligned blocks (start in row 0, start in row 1, size) of a coordinates array"""
+  coordinates = np.asarray(coordinates, dtype=np.int64)
+  steps = np.diff(coordinates, axis=1)
+  aligned = (steps[0] > 0) & (steps[1] > 0)
+  return np.stack([coordinates[0, :-1][aligned], coordinates[1, :-1][aligned], steps[0][aligned]], axis=1)
+
+def blocks_to_coordinates(blocks, size0, size1):
+  """
+  Return the coordinates array of sorted aligned blocks (start in row 0, start
+  in row 1, size) between sequences of sizes size0 and size1. Between two
+  blocks, the unaligned bases of row 0 are placed before the ones of row 1.
+  """
+  points = [(0, 0)]
+  last_aligned = False
+  for start0, start1, size in np.asarray(blocks, dtype=np.int64).reshape(-1, 3).tolist():
+    prev0, prev1 = points[-1]
+    if start0 == prev0 and start1 == prev1 and last_aligned:
+      # Adjacent blocks are merged
+      points[-1] = (start0 + size, start1 + size)
+      continue
+    if start0 > prev0:
+      points.append((start0, prev1))
+    if start1 > prev1:
+      points.append((start0, start1))
+    points.append((start0 + size, start1 + size))
+    last_aligned = True
+  prev0, prev1 = points[-1]
+  if size0 > prev0:
+    points.append((size0, prev1))
+  if size1 > prev1:
+    points.append((size0, size1))
+  return np.array(points, dtype=np.int64).T
+
+def read_chain(chain_file):
+  """
+  Read the coordinate mappings of a UCSC chain file, as read_coords. Only the
+  highest scoring chain of each (query, target) pair is kept.
+  """
+  chains = {}
+  with open(chain_file) as f:
+    header = None
+    for line in f:
+      fields = line.split()
+      if not fields or line.startswith("#"):
+        continue
+      if fields[0] == "chain":
+        score = float(fields[1])
+        t_name, t_size, t_start = fields[2], int(fields[3]), int(fields[5])
+        q_name, q_size, q_strand, q_start = fields[7], int(fields[8]), fields[9], int(fields[10])
+        query_id = q_name + REV_SUFFIX if q_strand == "-" else q_name
+        header = (query_id, t_name, score, q_size, t_size)
+        blocks = []
+        t_pos, q_pos = t_start, q_start
+        chains.setdefault((query_id, t_name), []).append((header, blocks))
+      else:
+        size = int(fields[0])
+        blocks.append((q_pos, t_pos, size))
+        if len(fields) >= 3:
+          t_pos += size + int(fields[1])
+          q_pos += size + int(fields[2])
+  coords_dict = {}
+  for ids, pair_chains in chains.items():
+    (_, _, _, q_size, t_size), blocks = max(pair_chains, key=lambda chain: chain[0][2])
+    coords_dict[ids] = blocks_to_coordinates(blocks, q_size, t_size)
+  return coords_dict
+
+def write_chain(coords_dict, chain_file):
+  """
+  Write coordinate mappings (row 0 the query, row 1 the target) to a UCSC
+  chain file, the score of a chain is its number of aligned bases.
+  """
+  with open(chain_file, "w") as f:
+    for chain_id, ((query_id, target_id), coordinates) in enumerate(coords_dict.items(), start=1):
+      blocks = coordinates_to_blocks(coordinates)
+      if len(blocks) == 0:
+        print(f"Warning: no aligned base between {query_id} and {target_id}, not written", file=sys.stderr)
+        continue
+      q_name, q_strand = query_id, "+"
+      if query_id.endswith(REV_SUFFIX):
+        q_name, q_strand = query_id[:-len(REV_SUFFIX)], "-"
+      q_starts, t_starts, sizes = blocks[:, 0], blocks[:, 1], blocks[:, 2]
+      f.write(f"chain {int(sizes.sum())} {target_id} {int(coordinates[1][-1])} + {t_starts[0]} {t_starts[-1] + sizes[-1]} "
+        f"{q_name} {int(coordinates[0][-1])} {q_strand} {q_starts[0]} {q_starts[-1] + sizes[-1]} {chain_id}\n")
+      t_gaps = t_starts[1:] - (t_starts[:-1] + sizes[:-1])
+      q_gaps = q_starts[1:] - (q_starts[:-1] + sizes[:-1])
+      for size, t_gap, q_gap in zip(sizes[:-1].tolist(), t_gaps.tolist(), q_gaps.tolist()):
+        f.write(f"{size}\t{t_gap}\t{q_gap}\n")
+      f.write(f"{sizes[-1]}\n\n")
+
+def read_coords(coords_file):
+  """
+  Read all the coordinate mappings of a coords.bin, coords.json or UCSC chain
+  file.
+
+  Returns a dictionary mapping (query_id, target_id) to (2, n) coordinates.
+  """
+  with open(coords_file, "rb") as f:
+    start = f.read(len(MAGIC))
+  if start == MAGIC:
+    coords_bin = CoordsFile(coords_file)
+    return {ids: coords_bin.coordinates(*ids) for ids in coords_bin.ids()}
+  if start.lstrip().startswith((b"chain", b"#")):
+    return read_chain(coords_file)
+  with open(coords_file) as f:
+    return {tuple(entry["ids"]): np.array(entry["coords"]) for entry in json.load(f)}
@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+
+"""
+Indexed random access to the records of a (multi) fasta file.
+
+The index is the samtools faidx one: <fasta>.fai with one line per record
+  name, length, offset of the sequence, bases per line, bytes per line
+It is reused if it is newer than the fasta, otherwise it is built with one
+pass over the file (and written next to the fasta if possible). Sequences are
+read from the file only when fetched, so only the records being processed
+are in memory.
+
+Records whose lines do not all have the same length (except the last one)
+cannot be fetched by offset: their sequences are kept in memory when the
+index is built and no .fai file is written.
+"""
+
+import os
+import sys
+from Bio.Seq import reverse_complement
+
+class FastaIndex:
+  """Lazy access to the sequences of a fasta file by record id"""
+
+  def __init__(self, fasta_file):
+    self.fasta_file = fasta_file
+    self.fai_file = fasta_file + ".fai"
+    # id -> (length, offset, line_bases, line_width), in file order
+    self.records = {}
+    # Sequences of the records with an irregular layout
+    self.loaded = {}
+    if os.path.exists(self.fai_file) and os.path.getmtime(self.fai_file) >= os.path.getmtime(fasta_file):
+      self._read_fai()
+    else:
+      self._build()
+
+  def _read_fai(self):
+    with open(self.fai_file) as f:
+      for line in f:
+        name, length, offset, line_bases, line_width = line.rstrip("\n").split("\t")[:5]
+        self.records[name] = (int(length), int(offset), int(line_bases), int(line_width))
+
+  def _build(self):
+    """Index the fasta in one pass, write the .fai if all records have a regular layout"""
+    name = None
+    with open(self.fasta_file, "rb") as f:
+      offset = 0
+      for line in f:
+        line_start = offset
+        offset += len(line)
+        if line.startswith(b">"):
+          if name is not None:
+            self._add_record(name, seq_start, line_sizes, lines)
+          name = line[1:].split(None, 1)[0].decode() if line[1:].strip() else ""
+          if name in self.records:
+            raise ValueError(f"Duplicated record id {name} in {self.fasta_file}")
+          seq_start = offset
+          line_sizes = []
+          lines = []
+        elif name is not None:
+          bases = line.rstrip(b"\r\n")
+          line_sizes.append((len(bases), len(line)))
+          lines.append(bases)
+      if name is not None:
+        self._add_record(name, seq_start, line_sizes, lines)
+    if not self.loaded:
+      try:
+        with open(self.fai_file, "w") as f:
+          for name, (length, offset, line_bases, line_width) in self.records.items():
+            f.write(f"{name}\t{length}\t{offset}\t{line_bases}\t{line_width}\n")
+      except OSError as e:
+        print(f"Warning: cannot write {self.fai_file} ({e}), the index is kept in memory", file=sys.stderr)
+
+  def _add_record(self, name, seq_start, line_sizes, lines):
+    # Trailing empty lines are not part of the sequence
+    while line_sizes and line_sizes[-1][0] == 0:
+      line_sizes.pop()
+      lines.pop()
+    length = sum(bases for bases, _ in line_sizes)
+    line_bases, line_width = line_sizes[0] if line_sizes else (0, 0)
+    regular = all(size == (line_bases, line_width) for size in line_sizes[:-1]) and \
+      (not line_sizes or 0 < line_sizes[-1][0] <= line_bases)
+    self.records[name] = (length, seq_start, line_bases, line_width)
+    if not regular:
+      self.loaded[name] = b"".join(lines).decode()
+
+  def ids(self):
+    """Return the record ids in file order"""
+    return list(self.records)
+
+  def __len__(self):
+    return len(self.records)
+
+  def __contains__(self, seq_id):
+    return seq_id in self.records
+
+  def length(self, seq_id):
+    return self.records[seq_id][0]
+
+  def fetch(self, seq_id, start=0, end=None):
+    """Return the sequence of a record (or its 0-based [start, end) slice) as a str"""
+    length, offset, line_bases, line_width = self.records[seq_id]
+    end = length if end is None else min(end, length)
+    if start >= end:
+      return ""
+    if seq_id in self.loaded:
+      return self.loaded[seq_id][start:end]
+    first = offset + (start // line_bases) * line_width + start % line_bases
+    last = offset + ((end - 1) // line_bases) * line_width + (end - 1) % line_bases + 1
+    with open(self.fasta_file, "rb") as f:
+      f.seek(first)
+      data = f.read(last - first)
+    return data.replace(b"\n", b"").replace(b"\r", b"").decode()
+
+  def fetch_rc(self, seq_id):
+    """Return the reverse complement of a record as a str"""
+    return reverse_complement(self.fetch(seq_id))
+
+  def description(self, seq_id):
+    """Return the header line (without ">") of a record"""
+    offset = self.records[seq_id][1]
+    size = 256
+    with open(self.fasta_file, "rb") as f:
+      while True:
+        chunk_start = max(0, offset - size)
+        f.seek(chunk_start)
+        chunk = f.read(offset - chunk_start).rstrip(b"\r\n")
+        header_start = chunk.rfind(b"\n>")
+        if header_start >= 0:
+          return chunk[header_start + 2:].decode()
+        if chunk_start == 0:
+          return chunk[1:].decode()
+        size *= 4
@@ -0,0 +1,223 @@
+#!/usr/bin/env python3
+
+"""
+Linear memory global alignment (Hirschberg / Myers-Miller) for the sequences
+whose traceback matrix does not fit in a memory budget.
+
+PairwiseAligner.align keeps a traceback matrix of about 2 bytes per DP cell
+(e.g. 2 GB for two 30 kb sequences). Here, the affine gap DP (Gotoh) of the
+aligner scores is only run row by row: the optimal path crossing the middle
+row is found from a forward and a backward pass, then both halves are
+aligned recursively, a gap crossing the middle row being kept whole. Small
+sub-problems are solved with a full traceback. The memory is linear in the
+length of the query and the time about twice the one of a full DP.
+
+The result is a Bio.Align.Alignment with the optimal score and a
+`coordinates` array of the same form as the first alignment of
+PairwiseAligner.align (gaps may be placed differently among co-optimal
+alignments). Only the match/mismatch scoring of a global aligner is supported
+(no substitution matrix), with gap extensions scoring at least as much as gap
+openings: the row DP lets a gap be closed and reopened at once, which would
+beat the optimum of PairwiseAligner otherwise.
+"""
+
+import numpy as np
+from Bio.Align import Alignment
+
+# Traceback memory of PairwiseAligner.align per DP cell (measured with
+# affine gaps on Biopython 1.8x)
+TRACE_BYTES_PER_CELL = 2
+
+# Sub-problems up to this number of cells are solved with a full traceback
+BASE_CELLS = 1 << 16
+
+def dp_memory(target, query):
+  """Estimated memory (bytes) of the traceback matrix of PairwiseAligner.align"""
+  return TRACE_BYTES_PER_CELL * (len(target) + 1) * (len(query) + 1)
+
+def global_align(aligner, target, query, max_memory=None):
+  """
+  Best global alignment of target and query: the first one of
+  PairwiseAligner.align if its traceback fits in max_memory (bytes, None for
+  no limit), the linear memory alignment otherwise. None if there is no
+  alignment.
+  """
+  if max_memory is None or dp_memory(target, query) <= max_memory:
+    return next(iter(aligner.align(target, query)), None)
+  return linear_align(aligner, target, query)
+
+def gap_scores(aligner, seq, size):
+  """Open and extend scores of a gap in seq ("target" or "query") at each position 0..size"""
+  open_scores = np.full(size + 1, getattr(aligner, f"{seq}_internal_open_gap_score"), dtype=np.float64)
+  extend_scores = np.full(size + 1, getattr(aligner, f"{seq}_internal_extend_gap_score"), dtype=np.float64)
+  for side, pos in (("left", 0), ("right", size)):
+    open_scores[pos] = getattr(aligner, f"{seq}_{side}_open_gap_score")
+    extend_scores[pos] = getattr(aligner, f"{seq}_{side}_extend_gap_score")
+  return open_scores, extend_scores
+
+def check_gap_scores(aligner):
+  """Raise a ValueError if a gap extension scores less than a gap opening"""
+  for seq in ("target", "query"):
+    for side in ("left", "internal", "right"):
+      open_score = getattr(aligner, f"{seq}_{side}_open_gap_score")
+      extend_score = getattr(aligner, f"{seq}_{side}_extend_gap_score")
+      if extend_score < open_score:
+        raise ValueError(f"Linear memory alignment requires gap extension scores >= gap opening scores "
+          f"({seq} {side}: open {open_score}, extend {extend_score})")
+
+def _dp_rows(rows, cols, v_open, v_extend, h_open, h_extend, match, mismatch, start_gap):
+  """
+  Yield the rows (H, H without horizontal gaps, D, I) of the affine gap DP of
+  the letters rows (one DP row each) against the letters cols. D ends with a
+  vertical move (gap in cols, scored by column), I with a horizontal one (gap
+  in rows, scored by row). With start_gap, a vertical gap is already open at
+  the origin.
+  """
+  positions = np.arange(len(cols) + 1)
+
+  def horizontal(h_diag, row):
+    # I[j] = max over k < j of h_diag[k] + open + (j - k - 1) * extend, as
+    # H includes I, a gap may also be reopened right after another one
+    extend = max(h_open[row], h_extend[row])
+    gaps = np.full(len(positions), -np.inf)
+    gaps[1:] = h_open[row] + (positions[1:] - 1) * extend + \
+      np.maximum.accumulate(h_diag - positions * extend)[:-1]
+    return gaps
+
+  h_diag = np.full(len(positions), -np.inf)
+  h_diag[0] = 0.0
+  d = np.full(len(positions), -np.inf)
+  if start_gap:
+    d[0] = 0.0
+  i = horizontal(h_diag, 0)
+  h = np.maximum(h_diag, i)
+  yield h, h_diag, d, i
+  for row in range(1, len(rows) + 1):
+    d = np.maximum(h + v_open, d + v_extend)
+    h_diag = np.full(len(positions), -np.inf)
+    h_diag[1:] = h[:-1] + np.where(cols == rows[row - 1], match, mismatch)
+    h_diag = np.maximum(h_diag, d)
+    i = horizontal(h_diag, row)
+    h = np.maximum(h_diag, i)
+    yield h, h_diag, d, i
+
+class _LinearAligner:
+  """Hirschberg recursion on the target (DP rows) against the query (DP columns)"""
+
+  def __init__(self, aligner, target, query):
+    self.target = np.frombuffer(str(target).encode(), dtype=np.uint8)
+    self.query = np.frombuffer(str(query).encode(), dtype=np.uint8)
+    self.match = aligner.match_score
+    self.mismatch = aligner.mismatch_score
+    # gaps in the target (moves along a row) are scored by row, gaps in the
+    # query (moves along a column) by column
+    self.h_open, self.h_extend = gap_scores(aligner, "target", len(self.target))
+    self.v_open, self.v_extend = gap_scores(aligner, "query", len(self.query))
+    self.points = []
+
+  def _rows(self, i0, i1, j0, j1, start_gap, reverse=False):
+    """DP rows of target[i0:i1] vs query[j0:j1], from the end if reverse"""
+    step = -1 if reverse else 1
+    return _dp_rows(self.target[i0:i1][::step], self.query[j0:j1][::step],
+      self.v_open[j0:j1 + 1][::step], self.v_extend[j0:j1 + 1][::step],
+      self.h_open[i0:i1 + 1][::step], self.h_extend[i0:i1 + 1][::step],
+      self.match, self.mismatch, start_gap)
+
+  def solve(self, i0, i1, j0, j1, start_gap=False, end_gap=False):
+    """
+    Append the points of the best path from (i0, j0) to (i1, j1) and return
+    its score. With start_gap (end_gap), a vertical gap at the start (end)
+    of the path continues a gap already open, its moves are all scored as
+    extensions.
+    """
+    if j0 == j1:
+      self.points.extend([(i0, j0), (i1, j0)])
+      extend = self.v_extend[j0] if start_gap or end_gap else self.v_open[j0]
+      return 0.0 if i0 == i1 else extend + (i1 - i0 - 1) * self.v_extend[j0]
+    if i1 - i0 <= 1 or (i1 - i0 + 1) * (j1 - j0 + 1) <= BASE_CELLS:
+      return self._traceback(i0, i1, j0, j1, start_gap, end_gap)
+
+    mid = (i0 + i1) // 2
+    for h_forward, _, d_forward, _ in self._rows(i0, mid, j0, j1, start_gap):
+      pass
+    for h_backward, _, d_backward, _ in self._rows(mid, i1, j0, j1, end_gap, reverse=True):
+      pass
+    h_join = h_forward + h_backward[::-1]
+    # a vertical gap crossing the middle row is opened once
+    d_join = d_forward + d_backward[::-1] - self.v_open[j0:j1 + 1] + self.v_extend[j0:j1 + 1]
+    # last best columns, closer to the path of PairwiseAligner.align
+    j_h = len(h_join) - 1 - int(np.argmax(h_join[::-1]))
+    j_d = len(d_join) - 1 - int(np.argmax(d_join[::-1]))
+    if h_join[j_h] >= d_join[j_d]:
+      self.solve(i0, mid, j0, j0 + j_h, start_gap, False)
+      self.solve(mid, i1, j0 + j_h, j1, False, end_gap)
+      return h_join[j_h]
+    # the moves (mid - 1, j) -> (mid, j) -> (mid + 1, j) are in the gap
+    self.solve(i0, mid - 1, j0, j0 + j_d, start_gap, True)
+    self.solve(mid + 1, i1, j0 + j_d, j1, True, end_gap)
+    return d_join[j_d]
+
+  def _traceback(self, i0, i1, j0, j1, start_gap, end_gap):
+    """Full DP of a small sub-problem, append the points of its best path"""
+    h, h_diag, d, i = (np.array(matrix) for matrix in zip(*self._rows(i0, i1, j0, j1, start_gap)))
+    v_open, v_extend = self.v_open[j0:j1 + 1], self.v_extend[j0:j1 + 1]
+    row, col = i1 - i0, j1 - j0
+    score = h[row, col]
+    state = "H"
+    if end_gap and d[row, col] - v_open[col] + v_extend[col] > score:
+      score = d[row, col] - v_open[col] + v_extend[col]
+      state = "D"
+    points = [(row, col)]
+    while row > 0 or col > 0:
+      if state == "H":
+        state = "diag" if h_diag[row, col] >= i[row, col] else "I"
+      elif state == "diag":
+        # H without horizontal gap: match / mismatch (preferred) or vertical gap
+        if row > 0 and col > 0 and h_diag[row, col] == h[row - 1, col - 1] + \
+            (self.match if self.target[i0 + row - 1] == self.query[j0 + col - 1] else self.mismatch):
+          row -= 1
+          col -= 1
+          state = "H"
+          points.append((row, col))
+        else:
+          state = "D"
+      elif state == "D":
+        if d[row, col] != d[row - 1, col] + v_extend[col]:
+          state = "H"
+        row -= 1
+        points.append((row, col))
+      else:
+        # the horizontal gap starts after the last k maximizing
+        # h_diag[k] - k * extend
+        extend = max(self.h_open[i0 + row], self.h_extend[i0 + row])
+        starts = h_diag[row, :col] - np.arange(col) * extend
+        col = int(np.flatnonzero(starts == starts.max())[-1])
+        state = "diag"
+        points.append((row, col))
+    self.points.extend((i0 + row, j0 + col) for row, col in reversed(points))
+    return score
+
+def simplify_coordinates(coordinates):
+  """Remove the empty steps and the points between two steps of the same kind"""
+  keep = np.ones(coordinates.shape[1], dtype=bool)
+  keep[1:] = np.any(np.diff(coordinates, axis=1) != 0, axis=0)
+  coordinates = coordinates[:, keep]
+  steps = np.diff(coordinates, axis=1) > 0
+  kinds = steps[0] + 2 * steps[1]
+  keep = np.ones(coordinates.shape[1], dtype=bool)
+  keep[1:-1] = kinds[1:] != kinds[:-1]
+  return coordinates[:, keep]
+
+def linear_align(aligner, target, query):
+  """
+  Global alignment of target and query in linear memory, returns a
+  Bio.Align.Alignment with its score.
+  """
+  if aligner.mode != "global" or aligner.substitution_matrix is not None:
+    raise ValueError("Linear memory alignment only supports the global mode with match / mismatch scores")
+  check_gap_scores(aligner)
+  problem = _LinearAligner(aligner, target, query)
+  score = problem.solve(0, len(problem.target), 0, len(problem.query))
+  alignment = Alignment([target, query], simplify_coordinates(np.array(problem.points, dtype=np.int64).T))
+  alignment.score = float(score)
+  return alignment
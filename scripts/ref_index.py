@@ -0,0 +1,216 @@
+#!/usr/bin/env python3
+
+"""
+Persistent memory-mapped index of a (reference) fasta file.
+
+  python3 scripts/ref_index.py build ref.fa [--kmer_size 15 --window_size 10]
+
+writes ref.fa.vvi next to the fasta. The scripts (align_coords.py,
+transfer_annot.py, check_results.py) memory-map it instead of reading the
+fasta text when it is up to date (same fasta size and modification time),
+so the processes of a batch share one page-cached copy of the sequences.
+
+Layout (little endian):
+  - magic b"VVREFIX1", uint64 size of the JSON header, JSON header
+      fasta_size, fasta_mtime_ns, kmer_size, window_size and for each contig
+      (in file order) id, description, length and the byte offsets of its
+      sequence, of its reverse complement and of the minimizers of both
+  - sequences and reverse complements as uint8 letters (the letters of the
+    fasta, so alignments are unchanged)
+  - sorted minimizer hashes (uint64) of each contig and of its reverse
+    complement, the sketch of align_coords.py --top_k for the k-mer and window
+    sizes of the index
+Arrays start at multiples of 8 bytes.
+
+Contigs are fetched with the FastaIndex interface (ids, length, fetch,
+fetch_rc, description), open_sequences returns a RefIndex if the index is up
+to date and a FastaIndex otherwise.
+"""
+
+import os
+import sys
+import json
+import argparse
+import numpy as np
+from Bio.Seq import reverse_complement
+from fasta_index import FastaIndex
+from anchored_align import encode_kmers
+
+MAGIC = b"VVREFIX1"
+INDEX_SUFFIX = ".vvi"
+
+def index_file(fasta_file):
+  return fasta_file + INDEX_SUFFIX
+
+def minimizer_hashes(seq, kmer_size, window_size):
+  """Sorted unique (hashed) minimizers of a sequence"""
+  # 2-bit encoding of all k-mers (case insensitive: the sketch only selects the
+  # candidates, scored by the aligner), k-mers with ambiguous bases are discarded
+  kmers, invalid = encode_kmers(seq, kmer_size, ignore_case=True)
+  n_kmers = len(kmers)
+  if n_kmers < 1:
+    return np.zeros(0, dtype=np.uint64)
+
+  # Invertible integer hash (splitmix64 finalizer) to avoid poly-A bias
+  hashes = kmers
+  hashes = (hashes ^ (hashes >> np.uint64(30))) * np.uint64(0xbf58476d1ce4e5b9)
+  hashes = (hashes ^ (hashes >> np.uint64(27))) * np.uint64(0x94d049bb133111eb)
+  hashes = hashes ^ (hashes >> np.uint64(31))
+  hashes[invalid] = np.iinfo(np.uint64).max
+
+  # Minimum hash for each window of consecutive k-mers
+  window_size = min(window_size, n_kmers)
+  minimizers = np.lib.stride_tricks.sliding_window_view(hashes, window_size).min(axis=1)
+  minimizers = np.unique(minimizers)
+  return minimizers[minimizers != np.iinfo(np.uint64).max]
+
+def build_index(fasta_file, kmer_size=15, window_size=10):
+  """Write the index of a fasta file (atomically, next to it)"""
+  stat = os.stat(fasta_file)
+  fasta = FastaIndex(fasta_file)
+  contigs = []
+  arrays = []
+  offset = 0
+
+  def add_array(array):
+    nonlocal offset
+    arrays.append((offset, array))
+    array_offset = offset
+    offset += (array.nbytes + 7) // 8 * 8
+    return array_offset
+
+  for seq_id in fasta.ids():
+    seq = fasta.fetch(seq_id)
+    rc = reverse_complement(seq)
+    contig = {"id": seq_id, "description": fasta.description(seq_id), "length": len(seq)}
+    contig["seq"] = add_array(np.frombuffer(seq.encode(), dtype=np.uint8))
+    contig["rc"] = add_array(np.frombuffer(rc.encode(), dtype=np.uint8))
+    for name, letters in (("minimizers", seq), ("rc_minimizers", rc)):
+      minimizers = minimizer_hashes(letters, kmer_size, window_size)
+      contig[name] = [add_array(minimizers), len(minimizers)]
+    contigs.append(contig)
+
+  header = json.dumps({
+    "fasta_size": stat.st_size,
+    "fasta_mtime_ns": stat.st_mtime_ns,
+    "kmer_size": kmer_size,
+    "window_size": window_size,
+    "contigs": contigs
+  }).encode()
+  data_start = (len(MAGIC) + 8 + len(header) + 7) // 8 * 8
+  tmp_file = f"{index_file(fasta_file)}.{os.getpid()}.tmp"
+  with open(tmp_file, "wb") as f:
+    f.write(MAGIC)
+    f.write(np.uint64(len(header)).tobytes())
+    f.write(header)
+    for array_offset, array in arrays:
+      f.seek(data_start + array_offset)
+      f.write(array.tobytes())
+    f.truncate(data_start + offset)
+  os.replace(tmp_file, index_file(fasta_file))
+
+class RefIndex:
+  """Memory-mapped index of a fasta file, same interface as FastaIndex"""
+
+  def __init__(self, fasta_file):
+    self.fasta_file = fasta_file
+    self.index_file = index_file(fasta_file)
+    self._open()
+
+  def _open(self):
+    self.data = np.memmap(self.index_file, dtype=np.uint8, mode="r")
+    if bytes(self.data[:len(MAGIC)]) != MAGIC:
+      raise ValueError(f"Not a reference index: {self.index_file}")
+    header_size = int(self.data[len(MAGIC):len(MAGIC) + 8].view(np.uint64)[0])
+    header_end = len(MAGIC) + 8 + header_size
+    self.header = json.loads(bytes(self.data[len(MAGIC) + 8:header_end]))
+    self.data_start = (header_end + 7) // 8 * 8
+    self.records = {contig["id"]: contig for contig in self.header["contigs"]}
+
+  # the memory map is reopened (not copied) in the worker processes
+  def __getstate__(self):
+    return {"fasta_file": self.fasta_file, "index_file": self.index_file}
+
+  def __setstate__(self, state):
+    self.__dict__.update(state)
+    self._open()
+
+  def is_current(self):
+    """True if the fasta was not modified since the index was built"""
+    try:
+      stat = os.stat(self.fasta_file)
+    except OSError:
+      return False
+    return stat.st_size == self.header["fasta_size"] and stat.st_mtime_ns == self.header["fasta_mtime_ns"]
+
+  def ids(self):
+    """Return the record ids in file order"""
+    return list(self.records)
+
+  def __len__(self):
+    return len(self.records)
+
+  def __contains__(self, seq_id):
+    return seq_id in self.records
+
+  def length(self, seq_id):
+    return self.records[seq_id]["length"]
+
+  def _letters(self, offset, length, start, end):
+    end = length if end is None else min(end, length)
+    if start >= end:
+      return ""
+    return self.data[self.data_start + offset + start:self.data_start + offset + end].tobytes().decode()
+
+  def fetch(self, seq_id, start=0, end=None):
+    """Return the sequence of a record (or its 0-based [start, end) slice) as a str"""
+    contig = self.records[seq_id]
+    return self._letters(contig["seq"], contig["length"], start, end)
+
+  def fetch_rc(self, seq_id):
+    """Return the reverse complement of a record as a str"""
+    contig = self.records[seq_id]
+    return self._letters(contig["rc"], contig["length"], 0, None)
+
+  def description(self, seq_id):
+    """Return the header line (without ">") of a record"""
+    return self.records[seq_id]["description"]
+
+  def minimizers(self, seq_id, kmer_size, window_size, is_rev=False):
+    """Stored minimizer hashes of a record (or of its reverse complement), None if indexed with other sizes"""
+    if (kmer_size, window_size) != (self.header["kmer_size"], self.header["window_size"]):
+      return None
+    offset, count = self.records[seq_id]["rc_minimizers" if is_rev else "minimizers"]
+    start = self.data_start + offset
+    return self.data[start:start + 8 * count].view(np.uint64)
+
+def load_index(fasta_file):
+  """RefIndex of a fasta file, None if there is no up to date index"""
+  if not os.path.exists(index_file(fasta_file)):
+    return None
+  index = RefIndex(fasta_file)
+  if not index.is_current():
+    print(f"Warning: {index.index_file} is older than {fasta_file}, not used", file=sys.stderr)
+    return None
+  return index
+
+def open_sequences(fasta_file):
+  """Indexed access to the records of a fasta file: its RefIndex if up to date, a FastaIndex otherwise"""
+  index = load_index(fasta_file)
+  return index if index is not None else FastaIndex(fasta_file)
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawTextHelpFormatter)
+  subparsers = parser.add_subparsers(dest="command", required=True)
+  build_parser = subparsers.add_parser("build", help="Build the index of fasta files (<fasta>.vvi)")
+  build_parser.add_argument("fasta", nargs="+", help="Fasta files")
+  build_parser.add_argument("--kmer_size", type=int, default=15,
+    help="k-mer size of the minimizers (align_coords.py --kmer_size)")
+  build_parser.add_argument("--window_size", type=int, default=10,
+    help="Window size of the minimizers (align_coords.py --window_size)")
+  args = parser.parse_args()
+  for fasta_file in args.fasta:
+    build_index(fasta_file, args.kmer_size, args.window_size)
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+
+"""
+Per-phase run metrics of the scripts (--metrics_json).
+
+The JSON file holds, for each named phase, the wall and CPU time summed
+over its calls, the counters (aligned pairs, DP cells, rows...), the total
+time (CPU of the process and of its terminated children) and the peak RSS of
+the process and of its children. With a profile file, the whole run is also
+profiled with cProfile (loadable with pstats or snakeviz).
+
+A single RunMetrics per process (metrics) is shared by the modules:
+
+  from run_metrics import metrics
+  with metrics.phase("align"):
+    ...
+  metrics.count("dp_cells", len(target) * len(query))
+  metrics.write(args.metrics_json)
+
+The tasks run in pool workers return their metrics to the parent, as the
+difference with a snapshot taken when they start:
+
+  snapshot = metrics.snapshot()
+  ...
+  return result, metrics.since(snapshot)
+
+and the parent adds them (add_task): their counters to its counters, the
+phases of the task to its phases (the wall times of concurrent tasks are
+summed) and the CPU time of the task to the phases open in the parent, as
+when the task is run in the parent process.
+"""
+
+import sys
+import json
+import time
+import copy
+import cProfile
+import resource
+from contextlib import contextmanager
+
+def cpu_time():
+  """CPU time (user + system) of the process and of its terminated children"""
+  children = resource.getrusage(resource.RUSAGE_CHILDREN)
+  return time.process_time() + children.ru_utime + children.ru_stime
+
+def peak_rss_kb(who=resource.RUSAGE_SELF):
+  """Peak resident set size in kB (ru_maxrss is in bytes on macOS)"""
+  peak = resource.getrusage(who).ru_maxrss
+  return peak // 1024 if sys.platform == "darwin" else peak
+
+class RunMetrics:
+  """Wall / CPU time of named phases and counters of a run"""
+
+  def __init__(self):
+    self.phases = {}
+    self.counters = {}
+    # Names of the phases being timed (nested)
+    self.open_phases = []
+    self.profiler = None
+    self.start_wall = time.perf_counter()
+    self.start_cpu = cpu_time()
+
+  @contextmanager
+  def phase(self, name):
+    """Time a phase, the times of a phase run several times are summed"""
+    wall, cpu = time.perf_counter(), time.process_time()
+    self.open_phases.append(name)
+    try:
+      yield
+    finally:
+      self.open_phases.pop()
+      self.add_phase(name, time.perf_counter() - wall, time.process_time() - cpu)
+
+  def add_phase(self, name, wall_s, cpu_s, calls=1):
+    """Add times to a phase"""
+    phase = self.phases.setdefault(name, {"wall_s": 0.0, "cpu_s": 0.0, "calls": 0})
+    phase["wall_s"] += wall_s
+    phase["cpu_s"] += cpu_s
+    phase["calls"] += calls
+
+  def count(self, name, value=1):
+    """Add value to a counter"""
+    self.counters[name] = self.counters.get(name, 0) + int(value)
+
+  def snapshot(self):
+    """Copy of the CPU time, phases and counters, taken when a task starts"""
+    return {"cpu_s": time.process_time(), "phases": copy.deepcopy(self.phases), "counters": dict(self.counters)}
+
+  def since(self, snapshot):
+    """CPU time, phases and counters added since a snapshot, e.g. by a task run in a pool worker"""
+    phases = {}
+    for name, phase in self.phases.items():
+      previous = snapshot["phases"].get(name, {"wall_s": 0.0, "cpu_s": 0.0, "calls": 0})
+      if phase["calls"] != previous["calls"]:
+        phases[name] = {key: phase[key] - previous[key] for key in phase}
+    counters = {name: value - snapshot["counters"].get(name, 0) for name, value in self.counters.items()
+      if value != snapshot["counters"].get(name, 0)}
+    return {"cpu_s": time.process_time() - snapshot["cpu_s"], "phases": phases, "counters": counters}
+
+  def add_task(self, task):
+    """Add the metrics of a task run in another process (see since)"""
+    for name in self.open_phases:
+      self.phases.setdefault(name, {"wall_s": 0.0, "cpu_s": 0.0, "calls": 0})["cpu_s"] += task["cpu_s"]
+    for name, phase in task["phases"].items():
+      self.add_phase(name, phase["wall_s"], phase["cpu_s"], phase["calls"])
+    for name, value in task["counters"].items():
+      self.count(name, value)
+
+  def start_profile(self):
+    """Profile the rest of the run with cProfile"""
+    self.profiler = cProfile.Profile()
+    self.profiler.enable()
+
+  def write(self, metrics_file=None, profile_file=None):
+    """Write the metrics as JSON (and the cProfile stats if profiled)"""
+    if self.profiler is not None:
+      self.profiler.disable()
+      if profile_file:
+        self.profiler.dump_stats(profile_file)
+    if not metrics_file:
+      return
+    report = {
+      "command": sys.argv,
+      "wall_s": time.perf_counter() - self.start_wall,
+      "cpu_s": cpu_time() - self.start_cpu,
+      "peak_rss_kb": peak_rss_kb(),
+      "children_peak_rss_kb": peak_rss_kb(resource.RUSAGE_CHILDREN),
+      "phases": self.phases,
+      "counters": self.counters
+    }
+    with open(metrics_file, "w") as f:
+      json.dump(report, f, indent=2)
+
+# Metrics of the current process
+metrics = RunMetrics()
@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+
+"""
+Tabular outputs of the scripts: delimited text or columnar files.
+
+The columnar formats are Parquet (.parquet, .pq) and Arrow IPC (.arrow,
+.feather, .ipc), written with pyarrow which is only required for them. Their
+columns are typed (integer coordinates, floats, booleans), so downstream
+joins across samples and batches read only the columns they need without
+parsing text.
+
+  from table_io import table_format, write_table
+  write_table(results_df, "results.parquet")
+  with TableWriter("annot.arrow", "arrow") as writer:
+    writer.write(record_batch)
+"""
+
+import os
+import sys
+import pandas as pd
+
+TABLE_FORMATS = ("text", "parquet", "arrow")
+COLUMNAR_FORMATS = ("parquet", "arrow")
+EXTENSIONS = {".parquet": "parquet", ".pq": "parquet", ".arrow": "arrow", ".feather": "arrow", ".ipc": "arrow"}
+
+def table_format(path, out_format=None):
+  """Format of a table file, out_format if given, else from the extension (delimited text by default)"""
+  if out_format is not None:
+    return out_format
+  return EXTENSIONS.get(os.path.splitext(path)[1].lower(), "text")
+
+def import_pyarrow():
+  try:
+    import pyarrow
+    import pyarrow.ipc
+    import pyarrow.parquet
+  except ImportError:
+    sys.exit("pyarrow is required for the parquet and arrow outputs (pip install pyarrow)")
+  return pyarrow
+
+class TableWriter:
+  """Write pyarrow tables or record batches to a Parquet or Arrow IPC file, chunk by chunk"""
+
+  def __init__(self, path, out_format):
+    if out_format not in COLUMNAR_FORMATS:
+      raise ValueError(f"Not a columnar format: {out_format}")
+    self.pa = import_pyarrow()
+    self.path = path
+    self.out_format = out_format
+    self.writer = None
+    self.schema = None
+
+  def write(self, table):
+    if isinstance(table, self.pa.RecordBatch):
+      table = self.pa.Table.from_batches([table])
+    if self.writer is None:
+      # the schema of the file is the one of the first chunk
+      self.schema = table.schema
+      if self.out_format == "parquet":
+        self.writer = self.pa.parquet.ParquetWriter(self.path, self.schema)
+      else:
+        self.writer = self.pa.ipc.new_file(self.path, self.schema)
+    self.writer.write_table(table.cast(self.schema))
+
+  def close(self):
+    if self.writer is not None:
+      self.writer.close()
+      self.writer = None
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *exc):
+    self.close()
+
+def int_lists(values, counts):
+  """list<int64> array of the values split in lists of counts items"""
+  pa = import_pyarrow()
+  offsets = [0]
+  offsets.extend(int(offset) for offset in counts.cumsum())
+  return pa.ListArray.from_arrays(pa.array(offsets, type=pa.int32()), pa.array(values, type=pa.int64()))
+
+def write_table(df, path, out_format=None, sep="\t"):
+  """Write a pandas DataFrame as delimited text or as a columnar file"""
+  out_format = table_format(path, out_format)
+  if out_format not in COLUMNAR_FORMATS:
+    df.to_csv(path, sep=sep, index=False)
+    return
+  pa = import_pyarrow()
+  with TableWriter(path, out_format) as writer:
+    writer.write(pa.Table.from_pandas(df, preserve_index=False))
+
+def read_table(path, out_format=None, sep="\t", **kwargs):
+  """Read a table written by write_table as a pandas DataFrame"""
+  out_format = table_format(path, out_format)
+  if out_format not in COLUMNAR_FORMATS:
+    return pd.read_csv(path, sep=sep, **kwargs)
+  pa = import_pyarrow()
+  if out_format == "parquet":
+    table = pa.parquet.read_table(path)
+  else:
+    with pa.ipc.open_file(path) as reader:
+      table = reader.read_all()
+  return table.to_pandas()
@@ -1,128 +1,132 @@
-from Bio import SeqIO
 from Bio import Align
+from Bio.Seq import Seq
+from Bio.SeqRecord import SeqRecord
 import argparse
 import sys
 import csv
+import itertools
+from concurrent.futures import ProcessPoolExecutor
+from anchored_align import ALIGN_MODES, anchored_align
+from align_backends import ENGINES, SCORING_PRESETS, get_backend
+from coords_io import read_coords, CoordMap
+from align_cache import AlignmentCache, mode_tag
+from aln_report import write_alignment_summary, write_alignment_windows
+from run_metrics import metrics
+from ref_index import open_sequences
+from table_io import (TABLE_FORMATS, COLUMNAR_FORMATS, TableWriter,
+    import_pyarrow, int_lists, table_format)
+import numpy as np
+import pandas as pd
 
-def get_ref2alt(ref_file, alt_file, base1, verbose):
-    aligner = Align.PairwiseAligner()
-    aligner.mode = "global"
-    aligner.match_score = 5
-    aligner.mismatch_score = -4
-    aligner.open_gap_score = -10
-    aligner.extend_gap_score = -0.5
-    aligner.target_end_gap_score = -5
-    aligner.query_end_gap_score = -5
-    parsed_records = dict()
-    parsed_records["ref"] = list(SeqIO.parse(ref_file, "fasta"))
-    parsed_records["alt"] = list(SeqIO.parse(alt_file, "fasta"))
-    records = dict()
-    for key in parsed_records.keys():
-        if len(parsed_records[key]) != 1:
+def read_single_record(fasta_file):
+    # the record is read through the reference index (<fasta>.vvi, see
+    # ref_index.py) if up to date, the fasta index (<fasta>.fai, reused or
+    # created) otherwise, to check the number of contigs without parsing the
+    # file
+    with metrics.phase("read_fasta"):
+        index = open_sequences(fasta_file)
+        if len(index) != 1:
             sys.exit("1 and only 1 contig per fasta file required")
-        records[key] = parsed_records[key][0]
+        seq_id = index.ids()[0]
+        return SeqRecord(Seq(index.fetch(seq_id)), id = seq_id)
+
+def get_ref2alt(ref_file, alt_file, base1, verbose, align_mode="exhaustive",
+    anchor_size=15, cache_dir=None, cache_max_size=1024, max_alignments=10,
+    max_memory=4096, engine="biopython", scoring="annot"):
+    return align_ref2alt(read_single_record(ref_file),
+        read_single_record(alt_file), base1, verbose, align_mode, anchor_size,
+        cache_dir, cache_max_size, max_alignments = max_alignments,
+        max_memory = max_memory, engine = engine, scoring = scoring)
+
+def align_ref2alt(ref_record, alt_record, base1, verbose,
+    align_mode="exhaustive", anchor_size=15, cache_dir=None,
+    cache_max_size=1024, backend=None, max_alignments=10, max_memory=4096,
+    engine="biopython", scoring="annot"):
+    # same as get_ref2alt from already parsed records (and backend), the
+    # alignments whose traceback exceeds max_memory (MB) are computed in
+    # linear memory
+    if backend is None:
+        backend = get_backend(engine, scoring, max_memory * 1024 * 1024)
+    aligner = backend.aligner
+    records = {"ref": ref_record, "alt": alt_record}
     if verbose:
         print("aligning %s with %s" % (records["ref"].id, records["alt"].id))
-    alignments = aligner.align(records["ref"].seq, records["alt"].seq)
-    best = alignments[0]
-    if verbose:
-        # Print the header for the summary table
-        print("Alignment Length | Aligned Bases from Target | Aligned Bases from Query | Alignment Score")
-        print("-" * 80)
-        # Iterate through the alignments and print the details
-        for alignment in alignments:
-            alignment_array = alignment.__array__()
-            target = "".join(map(lambda x: x.decode("utf-8"), alignment_array[0]))
-            query = "".join(map(lambda x: x.decode("utf-8"), alignment_array[1]))
-            alignment_length = len(target)
-            target_aligned_bases = sum(1 for x in target if x != '-')
-            query_aligned_bases = sum(1 for x in query if x != '-')
-            alignment_score = alignment.score
-
-            print(f"{alignment_length:^18} | {target_aligned_bases:^25} | {query_aligned_bases:^27} | {alignment_score:^18}")
-    alignment_array = best.__array__()
-
-    ref = "".join(map(lambda x: x.decode("utf-8"), alignment_array[0]))
-    alt = "".join(map(lambda x: x.decode("utf-8"), alignment_array[1]))
-    middle = ""
-    for char1, char2 in zip(alignment_array[0], alignment_array[1]):
-        if char1 == char2 and char1 != b'-':
-            middle += '|'
-        elif char1 == b'-' or char2 == b'-':
-            middle += ' '
+    cached = None
+    with metrics.phase("align"):
+        if cache_dir:
+            cache = AlignmentCache(cache_dir, cache_max_size)
+            key = cache.key(aligner, records["ref"].seq, records["alt"].seq,
+                mode_tag(align_mode, anchor_size))
+            cached = cache.get(key)
+        if cached is not None:
+            best = Align.Alignment([records["ref"].seq, records["alt"].seq],
+                cached[1])
+            best.score = cached[0]
+            alignments = [best]
+        elif align_mode == "anchored":
+            best = anchored_align(aligner, records["ref"].seq,
+                records["alt"].seq, anchor_size, backend.max_memory)
+            alignments = [best]
+            metrics.count("dp_cells", best.dp_cells)
         else:
-            middle += '.'
-    # start at 0 so that if no gap then the start seq is 1
-
-
-    if base1:
-        pos_alt = 0
-        ref2alt = [pos_alt]
-    else:
-        pos_alt = -1
-        ref2alt = []
-    
-    pos_ref_al = -1 # for verbose only
-    pos_alt_al = -1 # for verbose only
-
-    al2ref = []
-    al2alt = []
-
-    for i in range(0, len(ref)):
-        if alt[i] != "-":
-            pos_alt += 1
-            pos_alt_al += 1
-        if ref[i] != "-":
-            pos_ref_al += 1
-            ref2alt.append(pos_alt)
-        al2ref.append(pos_ref_al)
-        al2alt.append(pos_alt_al)
-    # add another iteration for non inclusive end
-    ref2alt.append(pos_alt + 1)
+            alignments = backend.align(records["ref"].seq, records["alt"].seq)
+            best = alignments[0]
+            metrics.count("dp_cells",
+                len(records["ref"].seq) * len(records["alt"].seq))
+        if cache_dir and cached is None:
+            cache.put(key, best.score, best.coordinates)
+    metrics.count("aligned_pairs")
+    if verbose:
+        with metrics.phase("write_report"):
+            write_alignment_summary(sys.stdout, alignments, max_alignments)
+    with metrics.phase("ref2alt"):
+        ref2alt = ref2alt_from_coordinates(best.coordinates, base1)
 
     if verbose:
-        win_size = 50 # print window size
-        i = 0
-        s = win_size * (i)
-        e = win_size * (i + 1)
-
-        def format_pos(pos):
-            return str(pos) + " " * (10 - len(str(pos)))
-
-        while ref[s:e] != "":
-            s = win_size * (i)
-            e = win_size * (i + 1)
-            if e > len(ref):
-                e = len(ref)
-            mid_s = format_pos(s)
-            mid_e = " " + str(e - 1)
-            ref_s = format_pos(al2ref[s])
-            ref_e = " " + str(al2ref[e - 1])
-            alt_s = format_pos(al2alt[s])
-            alt_e = " " + str(al2alt[e - 1])
-            print("")
-            print("print alignment with 0-based coord")
-            print("")
-            print(ref_s + ref[s:e] + ref_e)
-            print(mid_s + middle[s:e] + mid_e)
-            print(alt_s + alt[s:e] + alt_e)
-            i = i + 1
+        with metrics.phase("write_report"):
+            write_alignment_windows(sys.stdout, best)
     return ref2alt
 
+def ref2alt_from_coordinates(coordinates, base1, ref_row = 0):
+    # ref2alt[ref_pos] is the alt position of the ref base (or of the last
+    # alt base before the ref base if it is deleted in alt), with an extra
+    # item for the non inclusive end, stored by alignment blocks (CoordMap)
+    return CoordMap.from_coordinates(coordinates, reverse = ref_row == 1,
+        base1 = base1)
+
+def get_ref2alt_from_coords(coords_file, base1, ref_is_query):
+    # ref2alt mapping of each reference contig from the coordinates computed
+    # by align_coords.py (coords.json or coords.bin): {ref_id: (alt_id, ref2alt)}
+    mappings = dict()
+    for (query_id, target_id), coordinates in read_coords(coords_file).items():
+        ref_id, alt_id = (query_id, target_id) if ref_is_query \
+            else (target_id, query_id)
+        ref2alt = ref2alt_from_coordinates(coordinates, base1,
+            ref_row = 0 if ref_is_query else 1)
+        mappings[ref_id] = (alt_id, ref2alt)
+    return mappings
+
 def transform_coordinates(source_index, coordinate_mapping):
-    len_map = len(coordinate_mapping)
-    if source_index >= len_map:
-        raise ValueError(f"Index ({source_index}) >= List size {len_map}")
-    return max(coordinate_mapping[source_index], 0)
+    return coordinate_mapping.transform(source_index)
 
 def process_file(input_file, output_file, columns_to_transform,    start_column,
-    size_column, column_delimiter, intra_column_delimiter, coordinate_mapping):
+    size_column, column_delimiter, intra_column_delimiter, coordinate_mapping,
+    seqid_column = None):
+    # with seqid_column, coordinate_mapping is {ref_id: (alt_id, ref2alt)} and
+    # the seqid of each row is replaced by the alt_id
     with open(input_file, "r") as infile, \
         open(output_file, "w", newline="") as outfile:
         reader = csv.reader(infile, delimiter=column_delimiter)
         writer = csv.writer(outfile, delimiter=column_delimiter)
+        contig_mappings = coordinate_mapping
 
+        n_rows = 0
         for row in reader:
+            n_rows += 1
+            if seqid_column is not None:
+                if row[seqid_column] not in contig_mappings:
+                    raise ValueError(f"No coordinates mapping for contig {row[seqid_column]}")
+                row[seqid_column], coordinate_mapping = contig_mappings[row[seqid_column]]
             for col in columns_to_transform:
                 if col >= len(row):
                     raise ValueError("Given column not present")
@@ -150,18 +154,244 @@ def process_file(input_file, output_file, columns_to_transform,    start_column,
                 row[size_column] = intra_column_delimiter.join(transformed_size_values)
 
             writer.writerow(row)
+    metrics.count("rows", n_rows)
+
+def transform_coordinates_array(source_indexes, coordinate_mapping):
+    return coordinate_mapping.transform_array(source_indexes)
+
+def explode_values(column, intra_column_delimiter):
+    # all the int values of the intra column lists and the number of values
+    # in each row (delimiters are counted on the bytes of the joined rows)
+    joined = "\n".join(column.tolist()).replace(intra_column_delimiter, "\0")
+    buffer = np.frombuffer(joined.encode(), dtype = np.uint8)
+    row_ends = np.append(np.flatnonzero(buffer == ord("\n")), len(buffer))
+    delimiters = np.concatenate([[0], np.cumsum(buffer == 0)])[row_ends]
+    counts = np.diff(delimiters, prepend = 0) + 1
+    values = np.array(list(map(int, joined.replace("\n", "\0").split("\0"))),
+        dtype = np.int64)
+    return values, counts
+
+def join_values(values, counts, intra_column_delimiter):
+    # back to one intra column list per row
+    strings = list(map(str, values.tolist()))
+    if (counts == 1).all():
+        return strings
+    separators = np.full(len(strings), intra_column_delimiter, dtype = object)
+    separators[np.cumsum(counts) - 1] = "\n"
+    parts = np.empty(2 * len(strings), dtype = object)
+    parts[0::2] = strings
+    parts[1::2] = separators
+    return "".join(parts.tolist()).split("\n")[:-1]
+
+def truncate_values(values, counts, kept_counts):
+    # keep the kept_counts first values of each row
+    ranks = np.arange(len(values)) - np.repeat(np.cumsum(counts) - counts, counts)
+    return values[ranks < np.repeat(kept_counts, counts)]
+
+def transform_chunk(chunk, columns_to_transform, start_column, size_column,
+    intra_column_delimiter, coordinate_mapping, typed = False):
+    # the transformed chunk, as a pyarrow table with typed coordinate columns
+    # if typed
+    transformed = dict()
+
+    def column_values(col):
+        if col in transformed:
+            return transformed[col]
+        return explode_values(chunk[col], intra_column_delimiter)
+
+    for col in columns_to_transform:
+        if col >= chunk.shape[1]:
+            raise ValueError("Given column not present")
+        values, counts = column_values(col)
+        transformed[col] = (transform_coordinates_array(values,
+            coordinate_mapping), counts)
+
+    if start_column is not None and size_column is not None and start_column < chunk.shape[1] and size_column < chunk.shape[1]:
+        start_values, start_counts = column_values(start_column)
+        size_values, size_counts = column_values(size_column)
+        # pair start and size values as zip does
+        counts = np.minimum(start_counts, size_counts)
+        start_values = truncate_values(start_values, start_counts, counts)
+        size_values = truncate_values(size_values, size_counts, counts)
+        end_values = start_values + size_values
+        transformed_start = transform_coordinates_array(start_values,
+            coordinate_mapping)
+        transformed_end = transform_coordinates_array(end_values,
+            coordinate_mapping)
+        transformed_size = transformed_end - transformed_start
+        transformed[start_column] = (transformed_start, counts)
+        transformed[size_column] = (transformed_size, counts)
+
+    if typed:
+        return chunk_table(chunk, transformed)
+    for col, (values, counts) in transformed.items():
+        chunk[col] = join_values(values, counts, intra_column_delimiter)
+    return chunk
+
+def chunk_table(chunk, transformed):
+    # transformed columns as list<int64> (one item per intra column value),
+    # the other ones as strings, columns are named by their 0-based index
+    pa = import_pyarrow()
+    arrays = [int_lists(*transformed[col]) if col in transformed
+        else pa.array(chunk[col].tolist(), type = pa.string())
+        for col in chunk.columns]
+    return pa.table(arrays, names = [str(col) for col in chunk.columns])
+
+def width_chunks(rows):
+    # the rows of a chunk as DataFrames of string columns, one per number of
+    # fields (ragged inputs, e.g. BED6 and BED12 rows), indexed by the row
+    # positions in the chunk
+    widths = np.fromiter(map(len, rows), dtype = np.int64, count = len(rows))
+    for width in np.unique(widths):
+        positions = np.flatnonzero(widths == width)
+        yield pd.DataFrame([rows[i] for i in positions], index = positions,
+            columns = range(width), dtype = object)
+
+def process_file_columnar(input_file, output_file, columns_to_transform,
+    start_column, size_column, column_delimiter, intra_column_delimiter,
+    coordinate_mapping, seqid_column = None, chunk_size = 100000,
+    out_format = "text"):
+    # same output as process_file, the file is processed by chunks of rows and
+    # all coordinates of a chunk are mapped at once. Rows are read with the
+    # csv module as in process_file and transformed by groups of rows with
+    # the same number of fields, so that columns missing from short rows are
+    # handled per row. With a columnar out_format, the chunks are written as
+    # typed tables (see chunk_table).
+    typed = out_format in COLUMNAR_FORMATS
+    with open(input_file, "r") as infile, \
+        TableWriter(output_file, out_format) if typed \
+        else open(output_file, "w", newline="") as outfile:
+        reader = csv.reader(infile, delimiter=column_delimiter)
+        writer = None if typed else csv.writer(outfile,
+            delimiter=column_delimiter)
+        while True:
+            rows = list(itertools.islice(reader, chunk_size))
+            if not rows:
+                break
+            metrics.count("rows", len(rows))
+            parts = []
+            indexes = []
+            for chunk in width_chunks(rows):
+                if typed and len(parts) > 0:
+                    raise ValueError("Rows with different numbers of " + \
+                        "columns cannot be written as a table")
+                if seqid_column is None:
+                    indexes.append(chunk.index.to_numpy())
+                    parts.append(transform_chunk(chunk, columns_to_transform,
+                        start_column, size_column, intra_column_delimiter,
+                        coordinate_mapping, typed))
+                    continue
+                for seqid, group in chunk.groupby(seqid_column, sort = False):
+                    if seqid not in coordinate_mapping:
+                        raise ValueError(f"No coordinates mapping for contig {seqid}")
+                    alt_id, ref2alt = coordinate_mapping[seqid]
+                    group = group.copy()
+                    group[seqid_column] = alt_id
+                    indexes.append(group.index.to_numpy())
+                    parts.append(transform_chunk(group, columns_to_transform,
+                        start_column, size_column, intra_column_delimiter,
+                        ref2alt, typed))
+            if typed:
+                # back to the row order of the input
+                order = np.argsort(np.concatenate(indexes), kind = "stable")
+                outfile.write(import_pyarrow().concat_tables(parts).take(order))
+            else:
+                for positions, part in zip(indexes, parts):
+                    for position, row in zip(positions.tolist(),
+                        part.itertuples(index = False, name = None)):
+                        rows[position] = row
+                writer.writerows(rows)
+
+def transfer_annotation(args, output_file, ref2alt, seqid_column = None):
+    columns_to_transform = list(map(int, args.columns.split(",")))
+    out_format = table_format(output_file, args.out_format)
+
+    with metrics.phase("transform"):
+        if out_format in COLUMNAR_FORMATS:
+            # typed outputs are only written by the columnar engine
+            chunk_size = args.chunk_size if args.chunk_size > 0 else 100000
+            process_file_columnar(args.annot, output_file, columns_to_transform, args.start_column, args.size_column, args.column_delimiter, args.intra_column_delimiter, ref2alt, seqid_column, chunk_size, out_format)
+        elif args.chunk_size > 0:
+            process_file_columnar(args.annot, output_file, columns_to_transform, args.start_column, args.size_column, args.column_delimiter, args.intra_column_delimiter, ref2alt, seqid_column, args.chunk_size)
+        else:
+            process_file(args.annot, output_file, columns_to_transform, args.start_column, args.size_column, args.column_delimiter, args.intra_column_delimiter, ref2alt, seqid_column)
+
+# Per-process state for the batch workers
+_batch = dict()
+
+def init_batch_worker(args, ref_record=None):
+    # the workers read the reference themselves (from the memory map of its
+    # index if any) rather than receiving a pickled copy
+    _batch["ref"] = ref_record if ref_record is not None else \
+        read_single_record(args.ref)
+    _batch["backend"] = get_backend(args.engine, args.scoring,
+        args.max_memory * 1024 * 1024)
+    _batch["args"] = args
+
+def transfer_sample(sample):
+    # align one alt fasta against the shared reference and transfer the
+    # annotation to its output file, the metrics of the sample are returned
+    # to be added to the metrics of the parent process
+    alt_file, output_file = sample
+    args = _batch["args"]
+    snapshot = metrics.snapshot()
+    ref2alt = align_ref2alt(_batch["ref"], read_single_record(alt_file),
+        args.base1, args.verbose, args.align_mode, args.anchor_size,
+        args.cache_dir, args.cache_max_size, _batch["backend"],
+        args.max_alignments)
+    transfer_annotation(args, output_file, ref2alt)
+    return output_file, metrics.since(snapshot)
+
+def read_manifest(manifest_file):
+    # tab separated (alt fasta, output annotation) pairs
+    with open(manifest_file, "r") as f:
+        return [tuple(row[:2]) for row in csv.reader(f, delimiter = "\t")
+            if row and not row[0].startswith("#")]
+
+def run_batch(args):
+    samples = read_manifest(args.manifest)
+    metrics.count("samples", len(samples))
+    # checked once before starting the workers
+    ref_record = read_single_record(args.ref)
+    if args.threads > 1:
+        with ProcessPoolExecutor(max_workers = args.threads,
+            initializer = init_batch_worker,
+            initargs = (args,)) as executor:
+            for output_file, task in executor.map(transfer_sample,
+                samples):
+                metrics.add_task(task)
+                if args.verbose:
+                    print("written %s" % output_file)
+    else:
+        init_batch_worker(args, ref_record)
+        for output_file, _ in map(transfer_sample, samples):
+            if args.verbose:
+                print("written %s" % output_file)
 
 def main():
     parser = argparse.ArgumentParser(description = "Transfer an annotation " + \
         "from one contig to another (in whatever format)")
     parser.add_argument("-ref", metavar = "fasta", help = "reference fasta")
     parser.add_argument("-alt", metavar = "fasta", help = "alternative fasta")
+    parser.add_argument("-coords", metavar = "json|bin|chain",
+        help = "coordinates mappings from align_coords.py (coords.json or " + \
+        "coords.bin), compose_coords.py or a UCSC chain file used instead " + \
+        "of aligning -ref and -alt, multiple contigs are supported")
     parser.add_argument("-annot", metavar = "gff",
         help = "annotation file in GFF format")
     parser.add_argument("-out", metavar = "gff",
         help = "annotation for alternative fasta")
+    parser.add_argument("-manifest", metavar = "tsv",
+        help = "batch mode: tab separated file with one sample per line " + \
+        "(alternative fasta, output annotation), used instead of -alt " + \
+        "and -out. The reference is loaded once for all samples.")
+    parser.add_argument("--threads", default = 1, type = int,
+        help = "Number of samples processed in parallel in batch mode.")
     parser.add_argument("--verbose", action = "store_true",
         help = "Enable verbose logging")
+    parser.add_argument("--max_alignments", default = 10, type = int,
+        help = "Maximum number of co-optimal alignments summarized with " + \
+        "--verbose")
     parser.add_argument("--base1", action = "store_true",
         help = "First base is 1 not 0")
     parser.add_argument("--columns", default = "1,2,6,7",
@@ -174,14 +404,76 @@ def main():
         help = "Delimiter used between columns.")
     parser.add_argument("--intra_column_delimiter", default = ",",
         help ="Delimiter used within columns.")
+    parser.add_argument("--out_format", choices = TABLE_FORMATS,
+        default = None, help = "Output format: delimited text as the " + \
+        "input, or Parquet / Arrow IPC (requires pyarrow) with the " + \
+        "transformed columns as int64 lists and the other ones as " + \
+        "strings, columns named by their 0-based index (default: from " + \
+        "the output extension, .parquet, .arrow or text otherwise)")
+    parser.add_argument("--chunk_size", default = 100000, type = int,
+        help = "Number of rows transformed at once (columnar engine), " + \
+        "0 to transform row by row.")
+    parser.add_argument("--align_mode", choices = ALIGN_MODES,
+        default = "exhaustive", help = "Alignment mode: full global " + \
+        "alignment or global alignment between chained exact k-mer anchors")
+    parser.add_argument("--anchor_size", default = 15, type = int,
+        help = "k-mer size of anchors for the anchored mode.")
+    parser.add_argument("--engine", choices = ENGINES,
+        default = "biopython", help = "Alignment backend: Biopython " + \
+        "PairwiseAligner or linear memory alignment in pure numpy, " + \
+        "same scores but several times slower, to cross-check " + \
+        "biopython (see align_backends.py)")
+    parser.add_argument("--scoring", choices = list(SCORING_PRESETS),
+        default = "annot", help = "Scoring preset shared with " + \
+        "align_coords.py (see align_backends.py)")
+    parser.add_argument("--max_memory", default = 4096, type = float,
+        help = "Memory budget in MB of the alignment traceback, larger " + \
+        "alignments are computed in linear memory (slower)")
+    parser.add_argument("--cache_dir", default = None,
+        help = "Directory of the persistent alignment cache (disabled by " + \
+        "default)")
+    parser.add_argument("--cache_max_size", default = 1024, type = float,
+        help = "Size cap of the alignment cache in MB, least recently " + \
+        "used entries are evicted above")
+    parser.add_argument("--seqid_column", default = 0, type = int,
+        help = "Column with the contig id, used to select the mapping " + \
+        "with -coords.")
+    parser.add_argument("--ref_is_query", action = "store_true",
+        help = "With -coords, the reference is the query of " + \
+        "align_coords.py (default: the target)")
+    parser.add_argument("--metrics_json", default = None,
+        help = "Write the wall / CPU time of each phase, the peak RSS and " + \
+        "counters (aligned pairs, DP cells, rows) to this JSON file")
+    parser.add_argument("--profile", default = None,
+        help = "Write cProfile stats of the run to this file")
 
     args = parser.parse_args()
+    if args.profile:
+        metrics.start_profile()
 
-    ref2alt = get_ref2alt(args.ref, args.alt, args.base1, args.verbose)
+    if args.manifest:
+        if args.coords:
+            sys.exit("-coords is not supported with -manifest, each " + \
+                "sample is aligned to -ref")
+        with metrics.phase("batch"):
+            run_batch(args)
+        metrics.write(args.metrics_json, args.profile)
+        return
 
-    columns_to_transform = list(map(int, args.columns.split(",")))
+    if args.coords:
+        with metrics.phase("read_coords"):
+            ref2alt = get_ref2alt_from_coords(args.coords, args.base1,
+                args.ref_is_query)
+        seqid_column = args.seqid_column
+    else:
+        ref2alt = get_ref2alt(args.ref, args.alt, args.base1, args.verbose,
+            args.align_mode, args.anchor_size, args.cache_dir,
+            args.cache_max_size, args.max_alignments, args.max_memory,
+            args.engine, args.scoring)
+        seqid_column = None
 
-    process_file(args.annot, args.out, columns_to_transform, args.start_column, args.size_column, args.column_delimiter, args.intra_column_delimiter, ref2alt)
+    transfer_annotation(args, args.out, ref2alt, seqid_column)
+    metrics.write(args.metrics_json, args.profile)
 
 if __name__ == "__main__":
     main()